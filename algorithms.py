@@ -1,4 +1,9 @@
 import os
+import sys
+import glob
+import json
+import hashlib
+import tempfile
 
 import pandas as pd
 import numpy as np
@@ -16,21 +21,58 @@ from scipy.signal import spectrogram #, find_peaks_cwt
 
 #for peakdet
 from numpy import NaN, Inf, arange, isscalar, asarray, array
+from numpy.lib.stride_tricks import as_strided
 
 
 
 from time_series_segmentation import peak_detection
 import itertools
 
+# optional compiler for the peakdet kernels
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# optional FFTW engine for spec_power
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft
+    pyfftw.interfaces.cache.enable()
+except ImportError:
+    pyfftw = None
+
 col_names = ['ts','xa','ya','za','act']
 
 data_dir = os.path.realpath('.') +'\data'
 # filenames are 1 to 15
 data_files = [data_dir+os.path.sep+str(i)+'.csv' for i in range(1,16)]
 
+# parsed recordings are cached here by load_file
+cache_dir = data_dir+os.path.sep+'cache'
+
+# memory-mapped signals of all subjects, see build_signal_store
+store_dir = data_dir+os.path.sep+'store'
+
+# feature matrices cached by cached_features, evicted least recently used
+# first once they take more than feature_cache_size bytes
+feature_cache_dir = data_dir+os.path.sep+'features'
+feature_cache_size = 2**30
+
+# engine used by peakdet and peakdet_2d, see set_peakdet_backend
+peakdet_backends = ['numba', 'numpy'] if numba else ['numpy']
+peakdet_backend = peakdet_backends[0]
+
+# engine and precision used by spec_power, see set_spectral_backend
+spectral_backends = ['scipy', 'rfft', 'pyfftw'] if pyfftw else ['scipy', 'rfft']
+spectral_backend = 'scipy'
+spectral_dtype = np.float64
+# window, scale and frequencies of spec_power by (nFFT, fs, dtype)
+spectral_plans = {}
+
 
 #https://gist.github.com/sixtenbe/1178136#file-peakdetect-py
-def peakdet(v, delta, x = None):
+def peakdet_loop(v, delta, x = None):
     """
     Converted from MATLAB script at http://billauer.co.il/peakdet.html
     
@@ -102,30 +144,450 @@ def peakdet(v, delta, x = None):
     return array(maxtab), array(mintab)
 
 
+def turning_points(v):
+    """Returns the indices of v where the signal changes direction.
+
+    Repeated values are collapsed onto their first sample and the end points
+    are always kept.  peakdet only ever records an extremum at one of these
+    samples, and a threshold crossed part way down (or up) a monotone run is
+    also crossed at the end of it, so running the state machine over the
+    turning points alone gives the same peaks.
+    """
+    if len(v) < 2:
+        return arange(len(v))
+    keep = np.concatenate(([0], np.flatnonzero(v[1:] != v[:-1]) + 1))
+    u = v[keep]
+    up = u[1:] > u[:-1]
+    turns = np.flatnonzero(up[1:] != up[:-1]) + 1
+    return keep[np.concatenate(([0], turns, [len(u)-1]))] if len(u) > 1 else keep
+
+
+def peak_table(pos, vals):
+    """Builds a maxtab/mintab array the same way peakdet_loop does."""
+    if len(pos) == 0:
+        return array([])
+    tab = np.empty((len(pos), 2), dtype=np.result_type(pos, vals))
+    tab[:,0] = pos
+    tab[:,1] = vals
+    return tab
+
+
+def peakdet(v, delta, x = None):
+    """Drop-in replacement for peakdet_loop with identical output.
+
+    The turning points of v are found with array operations and the
+    hysteresis only visits those, which for accelerometer data is a small
+    fraction of the samples.  With the numba backend the full loop is
+    compiled instead.
+    """
+    v = asarray(v)
+
+    if x is None:
+        x = arange(len(v))
+    x = asarray(x)
+
+    if len(v) != len(x):
+        sys.exit('Input vectors v and x must have same length')
+    
+    if not isscalar(delta):
+        sys.exit('Input argument delta must be a scalar')
+    
+    if delta <= 0:
+        sys.exit('Input argument delta must be positive')
+
+    # NaNs never update the extrema, which neither engine reproduces
+    if v.dtype.kind == 'f' and np.isnan(v).any():
+        return peakdet_loop(v, delta, x)
+
+    if peakdet_backend == 'numba':
+        maxpos, minpos = peakdet_kernel(v.astype(np.promote_types(v.dtype, np.int64)), delta)
+    else:
+        maxpos, minpos = peakdet_turning(v, delta)
+
+    return peak_table(x[maxpos], v[maxpos]), peak_table(x[minpos], v[minpos])
+
+
+def peakdet_turning(v, delta):
+    """peakdet state machine run over the turning points of v.  Returns the
+    indices of the maxima and of the minima."""
+    tp = turning_points(v)
+    u = v[tp].tolist()
+
+    maxpos, minpos = [], []
+    if u:
+        mx = mn = u[0]
+        mxpos = mnpos = 0
+    lookformax = True
+
+    for i in range(1, len(u)):
+        this = u[i]
+        if lookformax:
+            if this > mx:
+                mx = this
+                mxpos = i
+            elif this < mx-delta:
+                maxpos.append(mxpos)
+                mn = this
+                mnpos = i
+                lookformax = False
+        else:
+            if this < mn:
+                mn = this
+                mnpos = i
+            elif this > mn+delta:
+                minpos.append(mnpos)
+                mx = this
+                mxpos = i
+                lookformax = True
+
+    return tp[np.array(maxpos, dtype=int)], tp[np.array(minpos, dtype=int)]
+
+
+class PeakDetector(object):
+    """peakdet for a signal that arrives in chunks.
+
+    mn, mx, mnpos, mxpos and lookformax are kept between feed calls, so
+    the peaks returned by all the feeds, stacked, are those of a single
+    peakdet call on the concatenated signal:
+
+        det = PeakDetector(delta)
+        tabs = [det.feed(c) for c in chunks]
+        maxtab = np.vstack([mx for mx, mn in tabs if len(mx)])
+
+    Positions count samples from the first chunk unless x is given.  Only
+    the state is kept, memory doesn't grow with the length of the signal.
+    """
+    def __init__(self, delta):
+        if not isscalar(delta):
+            sys.exit('Input argument delta must be a scalar')
+        if delta <= 0:
+            sys.exit('Input argument delta must be positive')
+        self.delta = delta
+        self.reset()
+
+    def reset(self):
+        """Starts over on a new signal"""
+        self.mn, self.mx = Inf, -Inf
+        self.mnpos, self.mxpos = NaN, NaN
+        self.lookformax = True
+        self.n_seen = 0
+
+    def feed(self, v, x = None):
+        """Runs peakdet over the next chunk v.  Returns (maxtab, mintab) of
+        the peaks that the chunk confirms; a peak is only known once the
+        signal has moved delta away from it, which may be in a later chunk.
+        """
+        v = asarray(v)
+        if x is None:
+            x = arange(self.n_seen, self.n_seen + len(v))
+        x = asarray(x)
+        if len(v) != len(x):
+            sys.exit('Input vectors v and x must have same length')
+        self.n_seen += len(v)
+
+        # as in peakdet only the turning points matter, except with NaNs
+        if v.dtype.kind == 'f' and np.isnan(v).any():
+            idx = arange(len(v))
+        else:
+            idx = turning_points(v)
+
+        delta = self.delta
+        mn, mx, mnpos, mxpos = self.mn, self.mx, self.mnpos, self.mxpos
+        lookformax = self.lookformax
+        maxtab, mintab = [], []
+        for this, pos in zip(v[idx].tolist(), x[idx].tolist()):
+            if this > mx:
+                mx = this
+                mxpos = pos
+            if this < mn:
+                mn = this
+                mnpos = pos
+
+            if lookformax:
+                if this < mx-delta:
+                    maxtab.append((mxpos, mx))
+                    mn = this
+                    mnpos = pos
+                    lookformax = False
+            else:
+                if this > mn+delta:
+                    mintab.append((mnpos, mn))
+                    mx = this
+                    mxpos = pos
+                    lookformax = True
+        self.mn, self.mx, self.mnpos, self.mxpos = mn, mx, mnpos, mxpos
+        self.lookformax = lookformax
+
+        return self.table(maxtab, x, v), self.table(mintab, x, v)
+
+    def table(self, tab, x, v):
+        """tab as the array peakdet would return"""
+        if not tab:
+            return array([])
+        pos, vals = zip(*tab)
+        return peak_table(np.array(pos, dtype=x.dtype), np.array(vals, dtype=v.dtype))
+
+
+def jit(f):
+    """Compiles f with numba if it is installed."""
+    if numba is None:
+        return f
+    return numba.njit(cache=True, nogil=True)(f)
+
+
+@jit
+def peakdet_kernel(v, delta):
+    """peakdet state machine over every sample of v, written for numba.
+    v must not contain NaNs.  Returns the indices of the maxima and of the
+    minima."""
+    n = len(v)
+    maxpos = np.empty(n, np.int64)
+    minpos = np.empty(n, np.int64)
+    n_max, n_min = 0, 0
+    if n == 0:
+        return maxpos[:0], minpos[:0]
+
+    mx, mn = v[0], v[0]
+    mxpos, mnpos = 0, 0
+    lookformax = True
+    for i in range(1, n):
+        this = v[i]
+        if lookformax:
+            if this > mx:
+                mx = this
+                mxpos = i
+            elif this < mx-delta:
+                maxpos[n_max] = mxpos
+                n_max += 1
+                mn = this
+                mnpos = i
+                lookformax = False
+        else:
+            if this < mn:
+                mn = this
+                mnpos = i
+            elif this > mn+delta:
+                minpos[n_min] = mnpos
+                n_min += 1
+                mx = this
+                mxpos = i
+                lookformax = True
+
+    return maxpos[:n_max], minpos[:n_min]
+
+
+@jit
+def peakdet_kernel_2d(V, delta):
+    """peakdet_kernel applied to every row of V.  Returns (row, index)
+    arrays for the maxima and for the minima, ordered by row."""
+    n_rows = V.shape[0]
+    size = n_rows * (V.shape[1] // 2 + 1)
+    max_rows, max_pos = np.empty(size, np.int64), np.empty(size, np.int64)
+    min_rows, min_pos = np.empty(size, np.int64), np.empty(size, np.int64)
+    n_max, n_min = 0, 0
+    for r in range(n_rows):
+        maxpos, minpos = peakdet_kernel(V[r], delta)
+        for p in maxpos:
+            max_rows[n_max] = r
+            max_pos[n_max] = p
+            n_max += 1
+        for p in minpos:
+            min_rows[n_min] = r
+            min_pos[n_min] = p
+            n_min += 1
+
+    return max_rows[:n_max], max_pos[:n_max], min_rows[:n_min], min_pos[:n_min]
+
+
+def peakdet_2d(V, delta, x = None):
+    """Batched peakdet over every row of the 2-D array V.
+
+    The state machine of peakdet_loop is stepped once per column with all
+    rows updated together.  Returns (maxtab, mintab), each a tuple of
+    (row, position, value) arrays ordered by row and then by position.  The
+    positions are column indices, or the matching x values if x is given.
+    """
+    V = asarray(V)
+    n_rows, n = V.shape
+
+    if x is None:
+        x = arange(n)
+    x = asarray(x)
+
+    if n != len(x):
+        sys.exit('Input vectors v and x must have same length')
+
+    if not isscalar(delta):
+        sys.exit('Input argument delta must be a scalar')
+
+    if delta <= 0:
+        sys.exit('Input argument delta must be positive')
+
+    tabs = [[[], [], []], [[], [], []]]
+    if n == 0:
+        return peak_rows(tabs[0], x, V), peak_rows(tabs[1], x, V)
+
+    # compare in the precision the scalar loop ends up using
+    W = V.astype(np.promote_types(V.dtype, np.int64))
+
+    if peakdet_backend == 'numba' and not (W.dtype.kind == 'f' and np.isnan(W).any()):
+        max_rows, max_pos, min_rows, min_pos = peakdet_kernel_2d(W, delta)
+        return ((max_rows, x[max_pos], V[max_rows, max_pos]),
+            (min_rows, x[min_pos], V[min_rows, min_pos]))
+    mx, mn = W[:,0].copy(), W[:,0].copy()
+    if W.dtype.kind == 'f':
+        mx[np.isnan(mx)] = -Inf
+        mn[np.isnan(mn)] = Inf
+    mxpos, mnpos = np.zeros(n_rows, dtype=int), np.zeros(n_rows, dtype=int)
+    lookformax = np.ones(n_rows, dtype=bool)
+
+    for i in range(1, n):
+        this = W[:,i]
+        up = this > mx
+        mx[up] = this[up]
+        mxpos[up] = i
+        down = this < mn
+        mn[down] = this[down]
+        mnpos[down] = i
+
+        hit_max = lookformax & (this < mx-delta)
+        hit_min = ~lookformax & (this > mn+delta)
+
+        if hit_max.any():
+            r = np.flatnonzero(hit_max)
+            tabs[0][0].append(r)
+            tabs[0][1].append(mxpos[r])
+            tabs[0][2].append(mx[r])
+            mn[r] = this[r]
+            mnpos[r] = i
+        if hit_min.any():
+            r = np.flatnonzero(hit_min)
+            tabs[1][0].append(r)
+            tabs[1][1].append(mnpos[r])
+            tabs[1][2].append(mn[r])
+            mx[r] = this[r]
+            mxpos[r] = i
+        lookformax ^= hit_max | hit_min
+
+    return peak_rows(tabs[0], x, V), peak_rows(tabs[1], x, V)
+
+
+def peak_rows(tab, x, V):
+    """Joins the per-column pieces collected by peakdet_2d into
+    (row, position, value) arrays sorted by row."""
+    rows, pos, vals = tab
+    if not rows:
+        return np.array([], dtype=int), x[:0], V.ravel()[:0]
+    rows, pos = np.concatenate(rows), np.concatenate(pos)
+    vals = np.concatenate(vals).astype(V.dtype)
+    # peaks were collected column by column, regroup them by row
+    order = np.argsort(rows, kind='mergesort')
+    return rows[order], x[pos[order]], vals[order]
+
+
+def split_rows(tab, n_rows):
+    """Splits a peakdet_2d table into a list with one maxtab/mintab per row."""
+    rows, pos, vals = tab
+    bounds = np.searchsorted(rows, np.arange(n_rows+1))
+    return [peak_table(pos[a:b], vals[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+
+def set_peakdet_backend(name):
+    """Selects the engine behind peakdet and peakdet_2d, and so behind the
+    time and spectral feature extractors: 'numba' (compiled) or 'numpy'."""
+    global peakdet_backend
+    if name not in peakdet_backends:
+        raise ValueError('peakdet backend %r is not available, use one of %s'
+            % (name, peakdet_backends))
+    peakdet_backend = name
+
+
+def peakdet_parity(signals=[], deltas=[1, 4, 40], n_random=20, win=256, seed=3):
+    """Checks every available peakdet backend against peakdet_loop.
+
+    Runs on n_random random walks plus the given signals (e.g. columns from
+    load_file), both whole with peakdet and cut into win sized rows with
+    peakdet_2d.  Returns a list of (signal number, delta, backend, function)
+    for every mismatch.
+    """
+    rng = np.random.RandomState(seed)
+    sigs = [rng.randn(rng.randint(win, 20*win)).cumsum()*10 for i in range(n_random)]
+    sigs.extend(asarray(i) for i in signals)
+
+    old_backend = peakdet_backend
+    failed = []
+    try:
+        for si, v in enumerate(sigs):
+            n_wins = len(v) // win
+            rows = v[:n_wins*win].reshape((n_wins, win))
+            for delta in deltas:
+                ref = peakdet_loop(v, delta)
+                ref_rows = [peakdet_loop(r, delta) for r in rows]
+                for backend in peakdet_backends:
+                    set_peakdet_backend(backend)
+                    mx, mn = peakdet(v, delta)
+                    if not (same_table(mx, ref[0]) and same_table(mn, ref[1])):
+                        failed.append((si, delta, backend, 'peakdet'))
+                    mx, mn = peakdet_2d(rows, delta)
+                    mx, mn = split_rows(mx, n_wins), split_rows(mn, n_wins)
+                    if not all(same_table(a, r[0]) and same_table(b, r[1])
+                            for a, b, r in zip(mx, mn, ref_rows)):
+                        failed.append((si, delta, backend, 'peakdet_2d'))
+    finally:
+        set_peakdet_backend(old_backend)
+
+    print len(sigs), 'signals,', len(failed), 'mismatches'
+    return failed
+
+
+def same_table(a, b):
+    """True if two maxtab/mintab arrays match exactly, dtype included."""
+    return a.dtype == b.dtype and a.shape == b.shape and (a == b).all()
+
 
 #
 # Helper functions
 #
 
-def load_file(file_path, act=None, col_names=col_names, use_fix=True):
-    '''reads file with appropriate header information'''
+def load_file(file_path, act=None, col_names=col_names, use_fix=True, use_cache=True,
+    store=None, compact=True):
+    '''reads file with appropriate header information
+
+    If store (from open_signal_store) is given the subject's rows, or just
+    its act segments, are taken from it instead of the file.
+
+    By default the frame is compact: int16 axes, uint8 act and subj and
+    float32 mag (wider types are kept for values that don't fit) and no
+    ts column, use frame_ts.  compact=False gives the old layout with
+    int64 columns and float64 ts and mag.
+    '''
     subject_number = lambda x: int(os.path.basename(x)[:-4])
 
-    dat = pd.read_csv(file_path, 
-        names=col_names, 
-        usecols=['xa','ya','za','act'])
-    
-    # only use fixed labels if directed
-    if use_fix:
-        act_file = file_path[:-4] + '.txt'
-        act_dat = pd.read_csv(act_file, names=['act'])
-        dat['act'] = act_dat
+    if store is not None:
+        dat = store_frame(store, subject_number(file_path), use_fix, wide=not compact,
+            act=act or None)
+    elif use_cache:
+        dat = read_cached_file(file_path, col_names, use_fix, wide=not compact)
+    else:
+        dat = read_file(file_path, col_names, use_fix)
     
-    # filter by action if not None
-    if act:
+    # filter by action if not None, the store was sliced already
+    if act and store is None:
         dat = dat.loc[dat.act == act]
+
+    if compact:
+        dat = pd.DataFrame(dict(
+            xa=narrow(dat.xa.values, np.int16),
+            ya=narrow(dat.ya.values, np.int16),
+            za=narrow(dat.za.values, np.int16),
+            act=narrow(dat.act.values, np.uint8)),
+            index=dat.index, columns=['xa','ya','za','act'])
+        dat['mag'] = signal_magnitude(dat).astype(np.float32)
+        dat['subj'] = np.full(dat.shape[0], subject_number(file_path), dtype=np.uint8)
+        return dat
     
-    ts = np.arange(0, dat.shape[0]/52., 1/52.)
+    ts = sample_times(dat.shape[0])
     dat['ts'] = ts
 
     dat['mag'] = signal_magnitude(dat)
@@ -137,24 +599,500 @@ def load_file(file_path, act=None, col_names=col_names, use_fix=True):
     return dat
 
 
-def load_data(data_files, subjs=range(1,16), act=None, col_names=['ya'], use_fix=True):
+def sample_times(n, fs=52.):
+    '''times of n samples taken at fs Hz, as in the ts column'''
+    return np.arange(0, n/fs, 1/fs)
+
+
+def frame_ts(dat):
+    '''dat's ts column, or the sample times of its rows for compact frames
+    without one'''
+    if 'ts' in dat.columns:
+        return dat.ts.values
+    return sample_times(dat.shape[0])
+
+
+def read_file(file_path, col_names=col_names, use_fix=True):
+    '''parses the xa, ya, za and act columns of a recording'''
+    dat = pd.read_csv(file_path, 
+        names=col_names, 
+        usecols=['xa','ya','za','act'])
+    
+    # only use fixed labels if directed
+    if use_fix:
+        act_file = label_file(file_path)
+        if act_file.endswith('.json'):
+            act_dat = pd.Series(expand_segments(read_label_segments(act_file)))
+        else:
+            act_dat = pd.read_csv(act_file, names=['act'])
+        dat['act'] = act_dat
+
+    return dat
+
+
+def label_file(file_path):
+    '''The fixed labels of a recording: the .json segment table written by
+    fix_ind, or an older per-sample .txt file if there is no table.'''
+    json_file = file_path[:-4] + '.json'
+    if os.path.exists(json_file):
+        return json_file
+    return file_path[:-4] + '.txt'
+
+
+def read_label_segments(json_file):
+    '''(act, start, stop) int64 array of a fix_ind label table'''
+    with open(json_file) as f:
+        table = json.load(f)
+    segs = np.array(table['segments'], dtype=np.int64).reshape((-1, 3))
+    if len(segs) and segs[-1, 2] != table['n_samples']:
+        raise ValueError('%s: segments end at %d, not n_samples' % (json_file, segs[-1, 2]))
+    return segs
+
+
+def expand_segments(segs, start=0, stop=None):
+    '''Per sample labels of rows start to stop (exclusive) from an
+    (act, start, stop) segment table'''
+    if stop is None:
+        stop = segs[-1, 2] if len(segs) else 0
+    lengths = np.minimum(segs[:,2], stop) - np.maximum(segs[:,1], start)
+    return np.repeat(segs[:,0], np.maximum(lengths, 0))
+
+
+def iter_file_segments(file_path, act=None, col_names=col_names, use_fix=True,
+    chunksize=2**16):
+    '''Reads a recording chunksize rows at a time and yields its activity
+    segments as (act, first row, (n, 3) array of xa, ya, za).
+
+    The csv and, with use_fix, its label file are read in lockstep and only
+    the rows of segments with activity act (all if None) are kept, so
+    memory grows with the longest segment instead of with the recording.
+    Labels are the same as read_file's; unlabelled rows (NaN act, past
+    the end of a short label file) are skipped.
+    '''
+    sig = pd.read_csv(file_path, names=col_names, usecols=['xa','ya','za','act'],
+        chunksize=chunksize)
+    if use_fix:
+        act_file = label_file(file_path)
+        if act_file.endswith('.json'):
+            segs = read_label_segments(act_file)
+        else:
+            labels = pd.read_csv(act_file, names=['act'], chunksize=chunksize)
+
+    seg_act, seg_start, parts = None, 0, []
+    for chunk in sig:
+        # labels are aligned on the row index like the assignment in read_file
+        if use_fix and act_file.endswith('.json'):
+            lab = expand_segments(segs, chunk.index[0], chunk.index[-1] + 1)
+            chunk['act'] = pd.Series(lab, index=chunk.index[:len(lab)])
+        elif use_fix:
+            lab = next(labels, None)
+            chunk['act'] = lab['act'] if lab is not None else NaN
+
+        X = chunk[['xa','ya','za']].values
+        acts, starts, stops = run_lengths(chunk['act'].values)
+        for a, start, stop in zip(acts, starts, stops):
+            if pd.isnull(a):
+                if parts:
+                    yield seg_act, seg_start, np.concatenate(parts)
+                seg_act, parts = None, []
+                continue
+            if start == 0 and a == seg_act:
+                if parts:
+                    parts.append(X[start:stop])
+                continue
+            if parts:
+                yield seg_act, seg_start, np.concatenate(parts)
+            seg_act, seg_start = a, chunk.index[start]
+            parts = [X[start:stop]] if act is None or a == act else []
+
+    if parts:
+        yield seg_act, seg_start, np.concatenate(parts)
+
+
+def cache_key(file_path, col_names=col_names, use_fix=True):
+    '''hash of the source files' path, mtime and size plus the parse options'''
+    sources = [file_path]
+    if use_fix:
+        sources.append(label_file(file_path))
+    key = [list(col_names), use_fix]
+    for f in sources:
+        st = os.stat(f)
+        key.append((os.path.abspath(f), st.st_mtime, st.st_size))
+    return hashlib.md5(repr(key).encode()).hexdigest()
+
+
+def read_cached_file(file_path, col_names=col_names, use_fix=True, wide=True):
+    '''read_file through a .npz cache in cache_dir.
+
+    The axes are stored as int16 and act as int8 when that loses nothing.
+    The cache file is named after the recording, use_fix and cache_key, so
+    the fixed and raw labels are cached side by side and editing the csv
+    or its label file misses the cache and replaces the stale entry.  Hits
+    are widened back to read_file's types unless wide is False.
+    '''
+    prefix = os.path.basename(file_path)[:-4] + ('_fix_' if use_fix else '_raw_')
+    cache_file = os.path.join(cache_dir,
+        prefix + cache_key(file_path, col_names, use_fix) + '.npz')
+
+    if os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        cols = ['xa','ya','za','act']
+        if not wide:
+            return pd.DataFrame(dict((c, cached[c]) for c in cols), columns=cols)
+        return pd.DataFrame(dict((c, widen(cached[c])) for c in cols), columns=cols)
+
+    dat = read_file(file_path, col_names, use_fix)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for old in glob.glob(os.path.join(cache_dir, prefix + '*.npz')):
+        if old != cache_file:
+            os.remove(old)
+    tmp_file = temp_file(cache_dir, '.npz')
+    np.savez(tmp_file,
+        xa=narrow(dat.xa.values, np.int16),
+        ya=narrow(dat.ya.values, np.int16),
+        za=narrow(dat.za.values, np.int16),
+        act=narrow(dat.act.values, np.int8))
+    move_into_place(tmp_file, cache_file)
+
+    return dat
+
+
+def temp_file(directory, suffix):
+    '''A new empty file in directory with a name no other process uses'''
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=directory)
+    os.close(fd)
+    return path
+
+
+def move_into_place(tmp_file, path):
+    '''Renames tmp_file to path.  If another process got there first (the
+    rename fails on Windows) its copy is kept and tmp_file dropped.'''
+    try:
+        os.rename(tmp_file, path)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+        os.remove(tmp_file)
+
+
+def narrow(a, dtype):
+    '''a as dtype if the values survive the cast, else a unchanged'''
+    if a.dtype == dtype:
+        return a
+    b = a.astype(dtype)
+    if (b == a).all():
+        return b
+    return a
+
+
+def widen(a):
+    '''undoes narrow for integer columns, which read_csv parses as int64'''
+    if a.dtype.kind == 'i':
+        return a.astype(np.int64)
+    return a
+
+
+def load_data(data_files, subjs=range(1,16), act=None, col_names=['ya'], use_fix=True,
+    store=None, with_index=False, compact=True, views=False):
+    '''Loads and concatenates the recordings of subjs.  With with_index a
+    RowIndex of the result is returned too, as (data, index).  compact
+    selects the column types, see load_file.
+
+    With views no frame is built: returns {subj: store_signals(store, subj,
+    act, col_names)}, read-only memory-mapped views of the col_names columns
+    of every act segment (every subject's rows if act is None), which
+    share the store's page cache between processes.  Needs a store.'''
     subject_number = lambda x: int(os.path.basename(x)[:-4])
     data_files_selected = [i for i in data_files if subject_number(i) in subjs]
+
+    if views:
+        if store is None:
+            raise ValueError('views are taken from a store, see open_signal_store')
+        if store['use_fix'] != use_fix:
+            raise ValueError('signal store was built with use_fix=%s' % store['use_fix'])
+        return dict((subject_number(f), store_signals(store, subject_number(f), act or None,
+            col_names)) for f in data_files_selected)
     
-    data = pd.DataFrame()
+    blocks = []
     for i, f in enumerate(data_files_selected):
         print subject_number(f),
         if act:
-            d = load_file(f, act=act, use_fix=use_fix)
+            d = load_file(f, act=act, use_fix=use_fix, store=store, compact=compact)
         else:
-            d = load_file(f, use_fix=use_fix)
+            d = load_file(f, use_fix=use_fix, store=store, compact=compact)
         #subj_col = [subject_number(f)] * d.shape[0]
         #d['subj'] = subj_col
-        data = data.append(d, ignore_index=True)
+        blocks.append(d)
 
+    data = concat_frames(blocks)
+    if with_index:
+        return data, RowIndex(data)
     return data
 
 
+def concat_frames(blocks, ignore_index=True):
+    '''Concatenates DataFrame blocks collected in a loop in one go.
+
+    Use this instead of growing a frame with X = X.append(...), which copies
+    everything accumulated so far on every call.
+    '''
+    if not blocks:
+        return pd.DataFrame()
+    return pd.concat(blocks, ignore_index=ignore_index)
+
+
+class RowIndex(object):
+    """Row ranges of every (subject, activity) run of a frame, so groups
+    are taken as slices instead of with a boolean mask over every row:
+
+        index.take(data, subj=3, act=4)  is  data[(data.subj==3) & (data.act==4)]
+        index.take(data, subj=3)         is  data[data.subj==3]
+        index.take(data, act=NaN)        is  data[data.act.isnull()]
+
+    Lookups cost the number of runs, not the number of rows.  The index
+    belongs to the frame it was built from (see load_data); build a new
+    one for a filtered frame.
+    """
+    def __init__(self, data):
+        subj, act = data.subj.values, data.act.values
+        n = len(subj)
+        act_change = act[1:] != act[:-1]
+        if act.dtype.kind == 'f':
+            # unlabelled rows (NaN act) are one group, keyed on the NaN object
+            nan = np.isnan(act)
+            act_change &= ~(nan[1:] & nan[:-1])
+        starts = np.flatnonzero((subj[1:] != subj[:-1]) | act_change) + 1
+        starts = np.concatenate(([0], starts)) if n else starts
+        stops = np.append(starts[1:], n)
+
+        self.n_rows = n
+        self.ranges = {}
+        for s, a, start, stop in zip(subj[starts].tolist(), act[starts].tolist(),
+            starts.tolist(), stops.tolist()):
+            if a != a:
+                a = NaN
+            self.ranges.setdefault((s, a), []).append((start, stop))
+
+    def keys(self):
+        """(subject, activity) pairs present, unlabelled (NaN) last"""
+        return sorted(self.ranges, key=lambda k: (k[0], k[1] != k[1], k[1]))
+
+    def rows(self, subj=None, act=None):
+        """(start, stop) positional row ranges of subj and/or act in row
+        order, adjacent ranges merged.  act=NaN selects the unlabelled rows."""
+        rngs = sorted(r for (s, a), rs in self.ranges.items()
+            if (subj is None or s == subj) and (act is None or a == act or
+                (a != a and act != act)) for r in rs)
+        merged = []
+        for start, stop in rngs:
+            if merged and merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], stop)
+            else:
+                merged.append((start, stop))
+        return merged
+
+    def take(self, data, subj=None, act=None):
+        """The rows of data for subj and/or act, as the mask would give them"""
+        if len(data) != self.n_rows:
+            raise ValueError('RowIndex was built for a frame of %d rows' % self.n_rows)
+        rngs = self.rows(subj, act)
+        if len(rngs) == 1:
+            return data.iloc[rngs[0][0]:rngs[0][1]]
+        if not rngs:
+            return data.iloc[:0]
+        return pd.concat([data.iloc[a:b] for a, b in rngs])
+
+
+def feature_key(kind, data, cols, params):
+    '''md5 of the feature kind, the extraction parameters and the contents
+    of data[cols]'''
+    h = hashlib.md5()
+    h.update(kind)
+    h.update(repr(sorted(params.items())))
+    for c in cols:
+        a = np.ascontiguousarray(data[c].values)
+        h.update(c + str(a.dtype) + str(a.shape))
+        h.update(a.view(np.uint8))
+    return h.hexdigest()
+
+
+def cached_features(kind, data, cols, params, build):
+    '''Returns the (X, y) made by build(), through the feature store.
+
+    Entries are keyed on feature_key, so any change to the signal, labels
+    or parameters misses the cache.  Hits refresh the entry's mtime, which
+    evict_features uses as the LRU order.
+    '''
+    key = feature_key(kind, data, cols, params)
+    path = os.path.join(feature_cache_dir, kind + '_' + key + '.pkl')
+
+    if os.path.exists(path):
+        os.utime(path, None)
+        X, y = pd.read_pickle(path)
+        print 'Feature Matrix loaded from cache:', X.shape[0], 'rows,', X.shape[1], 'columns.'
+        return X, y
+
+    X, y = build()
+
+    if not os.path.isdir(feature_cache_dir):
+        os.makedirs(feature_cache_dir)
+    tmp_file = temp_file(feature_cache_dir, '.tmp')
+    pd.to_pickle((X, y), tmp_file)
+    move_into_place(tmp_file, path)
+    evict_features()
+
+    return X, y
+
+
+def evict_features(max_bytes=None):
+    '''Deletes least recently used feature files until the store fits in
+    max_bytes (default feature_cache_size)'''
+    if max_bytes is None:
+        max_bytes = feature_cache_size
+    files = glob.glob(os.path.join(feature_cache_dir, '*.pkl'))
+    files = sorted((os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files)
+    total = sum(i[1] for i in files)
+    for mtime, size, f in files:
+        if total <= max_bytes:
+            break
+        os.remove(f)
+        total -= size
+
+
+def clear_feature_cache():
+    '''Invalidation hook: drops every cached feature matrix.  fix_ind calls
+    it after rewriting the label files.'''
+    for f in glob.glob(os.path.join(feature_cache_dir, '*.pkl')):
+        os.remove(f)
+
+
+def build_signal_store(data_files, use_fix=True, store_dir=store_dir):
+    '''Writes the raw signals of all data_files to store_dir for
+    open_signal_store.
+
+    Each of xa, ya, za and act becomes one contiguous .npy array with the
+    subjects back to back (int16 axes and int8 act where the values fit).
+    subjects.npy holds (subj, start, stop) rows and segments.npy holds
+    (subj, act, start, stop) for every run of one activity.  stop is
+    exclusive.  Unlabelled rows (NaN act) are kept but belong to no
+    segment.
+    '''
+    subject_number = lambda x: int(os.path.basename(x)[:-4])
+
+    cols = dict((c, []) for c in ['xa','ya','za','act'])
+    subjects, segments = [], []
+    start = 0
+    for f in data_files:
+        print subject_number(f),
+        dat = read_cached_file(f, use_fix=use_fix)
+        n = dat.shape[0]
+        subjects.append((subject_number(f), start, start+n))
+        acts, a, b = run_lengths(dat.act.values)
+        # rows past the end of a short label file have no activity
+        labelled = ~pd.isnull(acts)
+        segments.extend((subject_number(f), i, j+start, k+start)
+            for i, j, k in zip(acts[labelled], a[labelled], b[labelled]))
+        for c in cols:
+            cols[c].append(dat[c].values)
+        start += n
+    print
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    for c in cols:
+        a = np.concatenate(cols[c])
+        np.save(os.path.join(store_dir, c+'.npy'), narrow(a, np.int8 if c == 'act' else np.int16))
+    np.save(os.path.join(store_dir, 'subjects.npy'), np.array(subjects, dtype=np.int64))
+    np.save(os.path.join(store_dir, 'segments.npy'), np.array(segments, dtype=np.int64))
+    with open(os.path.join(store_dir, 'store.json'), 'w') as f:
+        json.dump({'use_fix': use_fix}, f)
+
+
+def open_signal_store(store_dir=store_dir):
+    '''Opens a store written by build_signal_store.
+
+    The signal arrays are memory-mapped read-only, so every process that
+    opens the store shares one page-cached copy.  Returns a dict with the
+    arrays plus 'subjects', 'segments' and 'use_fix'.
+    '''
+    store = {}
+    for c in ['xa','ya','za','act']:
+        store[c] = np.load(os.path.join(store_dir, c+'.npy'), mmap_mode='r')
+    store['subjects'] = np.load(os.path.join(store_dir, 'subjects.npy'))
+    store['segments'] = np.load(os.path.join(store_dir, 'segments.npy'))
+    with open(os.path.join(store_dir, 'store.json')) as f:
+        store['use_fix'] = json.load(f)['use_fix']
+    return store
+
+
+def store_rows(store, subj, act=None):
+    '''(start, stop) row ranges of a subject, or of its act segments'''
+    if act is None:
+        rows = store['subjects'][store['subjects'][:,0] == subj, 1:]
+    else:
+        segs = store['segments']
+        rows = segs[(segs[:,0] == subj) & (segs[:,1] == act), 2:]
+    return [tuple(r) for r in rows]
+
+
+def store_signals(store, subj, act=None, cols=['xa','ya','za','act']):
+    '''Views into the store for a subject: one dict of arrays per row
+    range from store_rows.  Nothing is read until the arrays are used.'''
+    return [dict((c, store[c][a:b]) for c in cols) for a, b in store_rows(store, subj, act)]
+
+
+def store_frame(store, subj, use_fix=True, wide=True, act=None):
+    '''A subject's rows from the store as the DataFrame read_file gives,
+    or in the store's narrow types if wide is False.
+
+    With act only that activity's segments are read, found in the store's
+    segment table, and the rows keep their place in the recording as index,
+    as after load_file's act filter.  Each column is copied once, into the
+    frame.'''
+    if store['use_fix'] != use_fix:
+        raise ValueError('signal store was built with use_fix=%s' % store['use_fix'])
+    cols = ['xa','ya','za','act']
+    rows = store_rows(store, subj)
+    if not rows:
+        raise ValueError('subject %s is not in the signal store' % subj)
+    first, last = rows[0]
+    # act is stored as float if any subject has unlabelled rows; as in
+    # read_file it stays float only for a subject that has some
+    act_float = store['act'].dtype.kind == 'f' and np.isnan(store['act'][first:last]).any()
+    index = None
+    if act is not None:
+        rows = store_rows(store, subj, act)
+        index = np.concatenate([np.arange(a, b) for a, b in rows] + [np.zeros(0, dtype=int)]) - first
+
+    def column(c):
+        if len(rows) == 1:
+            x = store[c][rows[0][0]:rows[0][1]]
+        else:
+            x = np.concatenate([store[c][a:b] for a, b in rows] + [store[c][:0]])
+        if c == 'act' and not act_float:
+            x = narrow(x, np.int8)
+        return widen(x) if wide else x
+    return pd.DataFrame(dict((c, column(c)) for c in cols), index=index, columns=cols)
+
+
+def run_lengths(a):
+    '''Splits a into runs of equal values.  Returns the run values and the
+    start and (exclusive) stop index of every run.  Consecutive NaNs, e.g.
+    the unlabelled rows after a short label file, form one run.'''
+    a = asarray(a)
+    if len(a) == 0:
+        return a[:0], np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    change = a[1:] != a[:-1]
+    if a.dtype.kind == 'f':
+        nan = np.isnan(a)
+        change &= ~(nan[1:] & nan[:-1])
+    starts = np.concatenate(([0], np.flatnonzero(change) + 1))
+    stops = np.append(starts[1:], len(a))
+    return a[starts], starts, stops
+
+
 def signal_magnitude(dat):
     mag = np.sqrt(
         (dat.xa - dat.xa.mean())**2 +
@@ -164,34 +1102,35 @@ def signal_magnitude(dat):
 
 
 def activity_segs(dat):
+    """[first, last] index label of every activity 1 to 7"""
+    segs = get_activity_segments(dat)
     inds = []
     for a in range(1,8):
-        mn = min(dat.act[dat.act == a].index)
-        mx = max(dat.act[dat.act == a].index)
-        inds.append([mn,mx])
+        mine = segs[segs['act'] == a]
+        inds.append([mine['start'].min(), mine['end'].max()])
     return inds
 
 
-def get_activity_segments(dat):
-    '''Takes a pandas DataFrame and returns the row numbers where the "act"(ivity)
-    column changes values as a tuple of:
-    (action number, starting row, ending row)'''
-
-    segment_list = []
+# get_activity_segments fields; end is the last row of the segment
+segment_dtype = [('act', np.int64), ('start', np.int64), ('end', np.int64)]
 
-    # initial activity
-    ind = 0
-    old_act = dat.act[ind]
-    
-    # itterate through rows with named columns
-    for r in dat.itertuples():
 
-        new_act = r.act
-        if old_act != new_act:
-            segment_list.append((old_act, ind, r.Index-1))
-            old_act = new_act
-            ind = r.Index
-    return segment_list
+def get_activity_segments(dat):
+    '''Takes a pandas DataFrame and returns the row numbers where the "act"(ivity)
+    column changes values as a structured array of:
+    (action number, starting row, ending row)
+
+    Rows are index labels and ending rows are inclusive.  Every segment is
+    listed, including the last.  Unlabelled rows (NaN act) belong to no
+    segment.'''
+    acts, starts, stops = run_lengths(dat.act.values)
+    labelled = ~pd.isnull(acts)
+    acts, starts, stops = acts[labelled], starts[labelled], stops[labelled]
+    segs = np.empty(len(acts), dtype=segment_dtype)
+    segs['act'] = acts
+    segs['start'] = dat.index.values[starts]
+    segs['end'] = dat.index.values[stops-1]
+    return segs
 
 
 def prepare_data(data_files, dim='xa', n_peaks=5, test_ratio=.3, 
@@ -252,14 +1191,16 @@ def show_fft(dat, nFFT=256):
 
 #def plt_walking_psd(data, sig, n_peaks=6, nFFT=256, pk_dist=.3, show_peaks=False):
 def plt_walking_psd(data, sig, n_peaks=6, nFFT=256, delta=10, show_peaks=False):
+    subjs = sorted(set(data.subj))
+    index = RowIndex(data)
+    fq, pxx = welch_psd([index.take(data, subj=si, act=4)[sig].values for si in subjs], nFFT)
+
     plt.figure()
-    for si in list(set(data.subj)):
-        di = data[data.subj == si]
-        di = di[di.act == 4]
-        x = di[sig][:]
-        a,b,l = plt.psd(x, nFFT, 52., color='k', return_line=True)
-        # grab data from the plot
-        pwr, fq = l[0].get_ydata(), l[0].get_xdata()
+    for si, p in zip(subjs, pxx):
+        # in dB, as plt.psd draws it
+        pwr = 10*np.log10(p)
+        plt.plot(fq, pwr, 'k')
+        plt.grid(True)
         #p = peak_detection(pwr, n_peaks, 0, .02, int(pk_dist*52))
         #print pwr, fq  
         mx, mn = peakdet(pwr, delta=delta)
@@ -279,6 +1220,88 @@ def plt_walking_psd(data, sig, n_peaks=6, nFFT=256, delta=10, show_peaks=False):
     plt.show()
     #return pwr, fq
 
+def welch_psd(signals, nFFT=256, fs=52.):
+    """Welch PSD of every signal in signals as plt.psd(x, nFFT, fs) computes
+    it: the mean periodogram of the non-overlapping nFFT sample segments,
+    Hann windowed, not detrended, density scaled.  Signals shorter than
+    nFFT are zero padded, tails that don't fill a segment are dropped.
+
+    The segments of all the signals go through one FFT.  Returns (f, Pxx)
+    with a row of Pxx per signal.
+    """
+    segs, n_segs = [], []
+    for x in signals:
+        x = np.asarray(x, dtype=np.float64)
+        if len(x) < nFFT:
+            x = np.concatenate((x, np.zeros(nFFT - len(x))))
+        n = len(x) // nFFT
+        segs.append(x[:n*nFFT].reshape((n, nFFT)))
+        n_segs.append(n)
+
+    win = np.hanning(nFFT)
+    R = np.fft.rfft(win * np.concatenate(segs), n=nFFT)
+    P = (np.conjugate(R) * R).real
+    # one-sided, double all but DC (and Nyquist for even nFFT)
+    if nFFT % 2:
+        P[:, 1:] *= 2
+    else:
+        P[:, 1:-1] *= 2
+    P /= fs * (win*win).sum()
+
+    starts = np.cumsum([0] + n_segs[:-1])
+    Pxx = np.add.reduceat(P, starts, axis=0) / np.array(n_segs, dtype=float)[:, None]
+    return np.fft.rfftfreq(nFFT, 1./fs), Pxx
+
+
+def psd_features(data, sig='ya', act=4, nFFT=256, win_segs=None, n_peaks=3, delta=10):
+    """Gait features from the Welch PSD of every subject's sig during act
+    (all rows if None), without plotting.  Subjects without such rows are
+    left out.  Columns:
+
+        dom_freq    frequency of the strongest bin above DC
+        harm_ratio  power at twice dom_freq over power at dom_freq
+        pk<i>       first n_peaks peakdet maxima of the PSD in dB
+
+    With win_segs the PSD is taken over windows of win_segs consecutive
+    nFFT segments instead of the whole recording, one row per window.
+    Every PSD of every subject comes from one welch_psd call.
+    """
+    index = RowIndex(data)
+    subjs = sorted(set(s for s, a in index.keys()))
+
+    signals, subj_col, win_col = [], [], []
+    for si in subjs:
+        x = index.take(data, subj=si, act=act)[sig].values
+        if not len(x):
+            continue
+        if win_segs is None:
+            wins = [x]
+        else:
+            n = win_segs*nFFT
+            wins = [x[i:i+n] for i in range(0, len(x) - n + 1, n)]
+        signals.extend(wins)
+        subj_col.extend([si] * len(wins))
+        win_col.extend(range(len(wins)))
+
+    if not signals:
+        return pd.DataFrame()
+    f, Pxx = welch_psd(signals, nFFT)
+
+    rows = np.arange(len(Pxx))
+    k = Pxx[:, 1:].argmax(axis=1) + 1
+    k2 = np.minimum(2*k, len(f) - 1)
+    feats = pd.DataFrame({'subj': subj_col})
+    if win_segs is not None:
+        feats['win'] = win_col
+    feats['dom_freq'] = f[k]
+    feats['harm_ratio'] = np.where(2*k < len(f), Pxx[rows, k2] / Pxx[rows, k], NaN)
+
+    peaks = spec_peak_freqs((10*np.log10(Pxx)).T, f, n_peaks, delta)
+    for i in range(n_peaks):
+        feats['pk'+str(i)] = peaks[:, i]
+    return feats
+
+
 def plt_psd_w_peaks(x, delta=10):
     #p_ind = find_peaks(x)
     mx, mn = peakdet(x, delta=delta)
@@ -310,7 +1333,136 @@ def plt_harmon(dat, nFFT=128, fs=52, novr=0, nperseg=128):
         #plt.show()
 
 
+def spec_peak_freqs(Sxx, f, n_peaks=3, delta=50):
+    """Frequencies of the first n_peaks spectral maxima in every column of
+    the spectrogram Sxx, as a (n_slices, n_peaks) array.  Slices with fewer
+    peaks are padded with zeros.
+    """
+    n_slices = Sxx.shape[1]
+    peaks = np.zeros((n_slices, n_peaks))
+
+    rows, pos, _ = peakdet_2d(Sxx.T, delta=delta)[0]
+    # rank of each peak within its time slice
+    first = np.searchsorted(rows, np.arange(n_slices))
+    rank = np.arange(len(rows)) - first[rows]
+    keep = rank < n_peaks
+    peaks[rows[keep], rank[keep]] = f[pos[keep]]
+
+    return peaks
+
+
+def set_spectral_backend(name, dtype=np.float64):
+    """Selects how spec_power, and so the spectral features, computes
+    spectrograms:
+
+        'scipy'   scipy.signal.spectrogram, the reference
+        'rfft'    numpy real FFT of strided segments, windows cached
+        'pyfftw'  as 'rfft' with FFTW plans, if pyfftw is installed
+
+    dtype np.float32 computes in single precision where the engine can
+    (scipy, pyfftw) and returns float32 spectra.  'rfft' in float64 repeats
+    scipy's steps and gives the same spectra (bit for bit with scipy 1.2);
+    other engines and versions agree to 1e-12 of each spectrum's peak
+    power, float32 to 1e-5.  Peak frequencies can only change where two
+    bins differ by less than that.
+    """
+    global spectral_backend, spectral_dtype
+    if name not in spectral_backends:
+        raise ValueError('spectral backend %r is not available, use one of %s'
+            % (name, spectral_backends))
+    spectral_backend = name
+    spectral_dtype = np.dtype(dtype).type
+
+
+def spectral_config():
+    """(backend, dtype name) currently used by spec_power"""
+    return spectral_backend, np.dtype(spectral_dtype).name
+
+
+def backend_config():
+    """The peakdet and spectral backends currently selected, for
+    run_with_backends"""
+    return {'peakdet': peakdet_backend, 'spectral': spectral_backend,
+        'dtype': np.dtype(spectral_dtype).name}
+
+
+def run_with_backends(config, f, *args, **kwargs):
+    """Selects the backends of config (from backend_config) and calls f.
+
+    Parallel workers run f through this.  A worker that imports algorithms
+    afresh (spawned processes, e.g. on Windows) would otherwise compute
+    with the default backends instead of the parent's.
+    """
+    set_peakdet_backend(config['peakdet'])
+    set_spectral_backend(config['spectral'], config['dtype'])
+    return f(*args, **kwargs)
+
+
+def spectral_plan(nFFT, fs, dtype):
+    """(window, density scale, frequencies) for spec_power, made once"""
+    key = (nFFT, fs, dtype)
+    if key not in spectral_plans:
+        win = get_window(('tukey', .25), nFFT).astype(dtype)
+        scale = 1.0 / (fs * (win*win).sum())
+        spectral_plans[key] = (win, scale, np.fft.rfftfreq(nFFT, 1./fs))
+    return spectral_plans[key]
+
+
+def spec_power(X, fs=52., nFFT=256, noverlap=0):
+    """One-sided PSD spectrogram of the last axis of X with nFFT sample
+    segments, as spectrogram(X, fs, nfft=nFFT, nperseg=nFFT, noverlap,
+    axis=-1) returns it: (f, t, Sxx) with Sxx (..., n_freqs, n_slices).
+    Computed with the engine chosen by set_spectral_backend.
+    """
+    X = np.asarray(X, dtype=spectral_dtype)
+    if spectral_backend == 'scipy' or X.shape[-1] < nFFT:
+        return spectrogram(X, fs=fs, nfft=nFFT, noverlap=noverlap, nperseg=nFFT, axis=-1)
+
+    step = nFFT - noverlap
+    n_slices = (X.shape[-1] - noverlap) // step
+    segs = as_strided(X, shape=X.shape[:-1] + (n_slices, nFFT),
+        strides=X.strides[:-1] + (step*X.strides[-1], X.strides[-1]), writeable=False)
+
+    f, P = segment_power(segs, fs)
+    t = np.arange(nFFT/2., X.shape[-1] - nFFT/2. + 1, step) / float(fs)
+    return f, t, np.moveaxis(P, -1, -2)
+
+
+def segment_power(segs, fs=52.):
+    """One-sided PSD of every segment along the last axis of segs, as
+    spectrogram computes it for one time slice.  Returns (f, P) with P
+    (..., n_freqs) in spectral_dtype.  Uses FFTW with the 'pyfftw'
+    backend and numpy's rfft otherwise.
+    """
+    nFFT = segs.shape[-1]
+    win, scale, f = spectral_plan(nFFT, fs, spectral_dtype)
+
+    # the steps of scipy's _spectral_helper: detrend, window, FFT, |.|^2
+    segs = segs - segs.mean(axis=-1)[..., None]
+    segs = win * segs
+    if spectral_backend == 'pyfftw':
+        R = pyfftw.interfaces.numpy_fft.rfft(segs, n=nFFT)
+    else:
+        R = np.fft.rfft(segs, n=nFFT)
+    P = np.conjugate(R) * R
+    P *= scale
+    # one-sided, double all but DC (and Nyquist for even nFFT)
+    if nFFT % 2:
+        P[..., 1:] *= 2
+    else:
+        P[..., 1:-1] *= 2
+
+    return f, P.real.astype(spectral_dtype, copy=False)
+
+
 def get_spec_features(Dat, sig_comps='mag', nFFT=256, n_peaks=3, delta=50):
+    """Frequencies of the first n_peaks spectral peaks of every nFFT window
+    of the sig_comps columns, columns named <sig_comp>pk<i>.
+
+    The columns are stacked into one (n_channels, n_samples) array so a
+    single spectrogram call covers all of them, and the peaks of every
+    (channel, time slice) spectrum are found in one spec_peak_freqs call.
+    """
     fs = 52.
     novr = 0
     nperseg = nFFT
@@ -319,42 +1471,68 @@ def get_spec_features(Dat, sig_comps='mag', nFFT=256, n_peaks=3, delta=50):
         sig_comps = [sig_comps]
     #pk1,pk2 = get_spec_peaks(Dat.mag, novr=0)
 
-    feats = pd.DataFrame()
-    for sig_comp in sig_comps:
-        # Calculate the spectrogram
-        f,t,Sxx = spectrogram(Dat[sig_comp], fs=fs, nfft=nFFT, noverlap=novr, nperseg=nperseg)
-        #print 'Sxx.shape', Sxx.shape
-        n_nows = len(t)
-        # get activity labels
-        inds = np.arange(nFFT/2., nFFT*t.shape[0], nFFT)
-        inds = [int(i) for i in inds]
-    
-        # initialize for number of peaks to return
-        peaks = np.zeros((len(t), n_peaks))
-        # Find peaks for each time slice
-        for ti in range(t.shape[0]):
-            #print ti
-            mx, mn = peakdet(Sxx[:,ti], delta=delta)
-            mx, mn = mx.astype(int), mn.astype(int)
-            pk_inds = [i[0] for i in mx]
-            #print pk_inds
-            pk_freqs = [f[i] for i in pk_inds]
-            #print pk_freqs
-            if len(pk_freqs) >= n_peaks:
-                peaks[ti,:] = pk_freqs[:n_peaks]
-            else:
-                peaks[ti,:len(pk_freqs)] = pk_freqs
+    # in spectral_dtype whatever the column type, scipy would compute
+    # int16 and float32 columns in single precision
+    X = np.asarray(Dat[sig_comps], dtype=spectral_dtype).T
 
-        # collect in to DataFrame
-        col_names = [sig_comp+'pk'+str(i) for i in range(n_peaks)]
-        #print len(peaks)
-        for i in range(n_peaks):
-            #feats = pd.DataFrame(peaks, columns=col_names)
-            feats[col_names[i]] = peaks[:,i]
-    #print len(feats), len(acts)
-    #feats['act'] = acts
-    
-    return feats
+    peaks = spec_peak_table(X, nperseg, n_peaks, delta, fs=fs, noverlap=novr)
+
+    # collect in to DataFrame
+    col_names = [sig_comp+'pk'+str(i) for sig_comp in sig_comps for i in range(n_peaks)]
+    return pd.DataFrame(peaks, columns=col_names)
+
+
+def spec_peak_table(X, nFFT=256, n_peaks=3, delta=50, fs=52., noverlap=0):
+    """Spectral peak frequencies of every time slice of the channels X,
+    (n_channels, n_samples), as an (n_slices, n_channels*n_peaks) array
+    with the peaks of every channel side by side.
+    """
+    n_chans = X.shape[0]
+
+    # Calculate the spectrograms, Sxx is (n_chans, n_freqs, n_slices)
+    f,t,Sxx = spec_power(X, fs=fs, nFFT=nFFT, noverlap=noverlap)
+    n_slices = len(t)
+
+    # Find peaks for all channels and time slices at once
+    S = Sxx.transpose(1, 0, 2).reshape((len(f), n_chans*n_slices))
+    peaks = spec_peak_freqs(S, f, n_peaks, delta)
+    # one row per time slice, the peaks of every channel side by side
+    peaks = peaks.reshape((n_chans, n_slices, n_peaks)).transpose(1, 0, 2)
+    return peaks.reshape((n_slices, n_chans*n_peaks))
+
+
+def spec_feature_pyramid(data_files, nffts=[128, 256, 512], sig_comps=['xa','ya','za','mag'],
+    n_peaks=3, delta=50, act=None, use_fix=True):
+    """get_spec_features for several FFT sizes from a single load_data.
+
+    Returns one frame indexed by (nfft, subj, slice) with the peak columns
+    of every signal and the act label at the centre of each slice, e.g.
+    pyr.loc[256] holds the 256 point features of all subjects.
+
+    Each subject's signals are stacked once and every FFT size is one
+    batched spectrogram of all of them.  Coarse spectra are not derived
+    from fine ones: detrending and windowing are per segment, so a 512
+    point spectrum is not a combination of 256 point ones.
+    """
+    subject_number = lambda x: int(os.path.basename(x)[:-4])
+    subjs = [subject_number(f) for f in data_files]
+    data, index = load_data(data_files, subjs=subjs, act=act, use_fix=use_fix,
+        with_index=True)
+
+    col_names = [sig_comp+'pk'+str(i) for sig_comp in sig_comps for i in range(n_peaks)]
+    blocks, keys = [], []
+    for subj in subjs:
+        dat = index.take(data, subj=subj)
+        X = np.asarray(dat[sig_comps], dtype=spectral_dtype).T
+        acts = dat.act.values
+        for nfft in nffts:
+            d = pd.DataFrame(spec_peak_table(X, nfft, n_peaks, delta), columns=col_names)
+            d['act'] = acts[nfft//2 + nfft*np.arange(len(d))]
+            blocks.append(d)
+            keys.append((nfft, subj))
+
+    pyr = pd.concat(blocks, keys=keys, names=['nfft', 'subj', 'slice'])
+    return pyr.sort_index(level=['nfft', 'subj'], sort_remaining=False)
 
 
 def extract_spec_features(x, nFFT=256, n_peaks=3, delta=50):
@@ -365,7 +1543,7 @@ def extract_spec_features(x, nFFT=256, n_peaks=3, delta=50):
 
     feats = pd.DataFrame()
     # Calculate the spectrogram
-    f,t,Sxx = spectrogram(x, fs=fs, nfft=nFFT, noverlap=novr, nperseg=nFFT)
+    f,t,Sxx = spec_power(x, fs=fs, nFFT=nFFT, noverlap=novr)
     #print 'Sxx.shape', Sxx.shape
     n_nows = len(t)
 
@@ -377,22 +1555,9 @@ def extract_spec_features(x, nFFT=256, n_peaks=3, delta=50):
         acts = [Dat.act[i] for i in inds]
         #acts.reset_index()
 
-    # initialize for number of peaks to return
-    peaks = np.zeros((len(t), n_peaks))
-    # Find peaks for each time slice
-    for ti in range(t.shape[0]):
-        #print ti
-        mx, mn = peakdet(Sxx[:,ti], delta=delta)
-        mx, mn = mx.astype(int), mn.astype(int)
-        # only concered with maxima for frequency domain features.
-        pk_inds = [i[0] for i in mx]
-        #print pk_inds
-        pk_freqs = [f[i] for i in pk_inds]
-        #print pk_freqs
-        if len(pk_freqs) >= n_peaks:
-            peaks[ti,:] = pk_freqs[:n_peaks]
-        else:
-            peaks[ti,:len(pk_freqs)] = pk_freqs
+    # Find peaks for all time slices at once, only concered with maxima
+    # for frequency domain features.
+    peaks = spec_peak_freqs(Sxx, f, n_peaks, delta)
 
     return peaks
 
@@ -419,13 +1584,24 @@ def time_feature_scatter(X):
     plt.show()
 
 
-def extract_windowed_time_features(dat, ts, win_size, delta, typ='amp', jrk=1):
+def extract_windowed_time_features(dat, ts, win_size, delta, typ='amp', jrk=1,
+    hop_size=None, win_batch=1024):
+    """Time features for windows of win_size seconds starting every
+    hop_size seconds (default win_size, i.e. no overlap).  Windows are
+    strided views of dat, only win_batch of them are copied at a time.
+    """
     #print ts.shape
-    X = dat.as_matrix()
+    # int64 so jerk differences of compact int16 columns can't overflow
+    X = widen(dat.as_matrix())
     
-    win_size_samp = int(win_size/(ts[1]-ts[0]))
+    # rounded, so the length doesn't depend on where ts starts
+    win_size_samp = int(round(win_size/(ts[1]-ts[0])))
+    hop_samp = win_size_samp
+    if hop_size is not None:
+        hop_samp = int(round(hop_size/(ts[1]-ts[0])))
+    if hop_samp < 1:
+        raise ValueError('hop_size %r is shorter than one sample' % hop_size)
     #print 'win_size_samp', win_size_samp
-    n_wins = X.shape[0]/win_size_samp
 
     if jrk:
         rslt = np.empty([0,12])
@@ -441,29 +1617,17 @@ def extract_windowed_time_features(dat, ts, win_size, delta, typ='amp', jrk=1):
     # dat has one signal column
     if len(X.shape) == 1:
         lbls = lbl
-        x = X[:n_wins*win_size_samp]
-        x = x.reshape((n_wins, win_size_samp))
-        rslt = np.apply_along_axis(
-            compute_time_stats, 1, x, ts=ts, delta=delta)
-    # dat has multiple signal columns. Compute stats for each
-    # and collect results.
+        views = [window_view(X, win_size_samp, hop_samp)]
+        rslt = windowed_time_stats(views, ts, delta, win_batch=win_batch)
+    # dat has multiple signal columns. Compute stats for all windows of
+    # every column in one go and lay them out column by column.
     else:
-        rslt = np.empty([n_wins,0])
         for i in range(X.shape[1]):
-            #sig = dat.columns[i]
             sig = dat.columns[i]
-            #print sig
             lbls.extend([sig+j for j in lbl])
-        
-            x = X[:n_wins*win_size_samp, i]
-            x = x.reshape((n_wins, win_size_samp))
-            
-            r = np.apply_along_axis(
-                compute_time_stats, 1, x, ts=ts, delta=delta, typ=typ, jrk=jrk)
-            rslt = np.hstack((rslt, r))
-            #print lbls
-            #print '*', rslt.shape
-            #print r.shape
+
+        views = [window_view(X[:,i], win_size_samp, hop_samp) for i in range(X.shape[1])]
+        rslt = windowed_time_stats(views, ts, delta, typ=typ, jrk=jrk, win_batch=win_batch)
 
     #print len(lbls)
     result = pd.DataFrame(rslt)#, columns=lbls)
@@ -471,6 +1635,39 @@ def extract_windowed_time_features(dat, ts, win_size, delta, typ='amp', jrk=1):
     return result
 
 
+def window_view(x, win_size_samp, hop_samp=None):
+    """Read-only (n_wins, win_size_samp) view of the 1-D array x with a
+    window starting every hop_samp samples.  Nothing is copied, the tail
+    that doesn't fill a window is left out.
+    """
+    if hop_samp is None:
+        hop_samp = win_size_samp
+    n_wins = max(0, (len(x) - win_size_samp) // hop_samp + 1)
+    stride = x.strides[0]
+    return as_strided(x, shape=(n_wins, win_size_samp),
+        strides=(hop_samp*stride, stride), writeable=False)
+
+
+def windowed_time_stats(views, ts, delta, typ='amp', jrk=1, win_batch=1024):
+    """Runs compute_time_stats_2d over window views of one or more signals.
+
+    The same windows of every signal are stacked and processed together,
+    win_batch windows at a time, so memory stays bounded however much the
+    windows overlap.  Returns (n_wins, n_signals*n_stats), one block of
+    stats per signal.
+    """
+    n_sigs = len(views)
+    n_wins = views[0].shape[0]
+    n_stats = 12 if jrk else 6
+
+    rslt = np.empty((n_wins, n_sigs*n_stats))
+    for a in range(0, n_wins, win_batch):
+        x = np.concatenate([v[a:a+win_batch] for v in views])
+        r = compute_time_stats_2d(x, ts=ts, delta=delta, typ=typ, jrk=jrk)
+        rslt[a:a+win_batch] = r.reshape((n_sigs, -1, n_stats)).transpose(1, 0, 2).reshape((-1, n_sigs*n_stats))
+
+    return rslt
+
 
 def compute_time_stats(x, ts, delta=25, typ='amp', jrk=1):
     """Takes np.array, not pd.DataFrame
@@ -510,6 +1707,67 @@ def compute_time_stats(x, ts, delta=25, typ='amp', jrk=1):
     return rslt
 
 
+def compute_time_stats_2d(X, ts, delta=25, typ='amp', jrk=1):
+    """compute_time_stats for every row (window) of X at once.
+    Returns an array with one row of stats per window.
+    """
+    if typ == 'amp':
+        stats = window_diff_stats(X, delta=delta)
+        if jrk:
+            stats += window_diff_stats(np.diff(X, axis=1), delta=delta*.75)
+    else:
+        stats = window_diff_stats(X, delta=delta, ts=ts)
+        if jrk:
+            stats += window_diff_stats(np.diff(X, axis=1), delta=delta*.75, ts=ts[1:])
+
+    return np.hstack(stats)
+
+
+def window_diff_stats(X, delta=25, ts=None):
+    """Means and stds of the calculate_ts_amp_diffs peak differences for
+    every row of X, or of calculate_ts_diffs if ts is given.
+
+    Peaks come from a single peakdet_2d call.  Windows are grouped by their
+    number of differences so each group reduces exactly like the per-window
+    version.  Returns [means, stds], each of shape (n_rows, 3).
+    """
+    n_rows = X.shape[0]
+    (mx_rows, mx_pos, mx_val), (mn_rows, mn_pos, mn_val) = peakdet_2d(X, delta=delta)
+
+    # peak tables are cast to int in calculate_ts_*
+    mx_pos, mn_pos = mx_pos.astype(int), mn_pos.astype(int)
+    if ts is None:
+        mx_val, mn_val = mx_val.astype(int), mn_val.astype(int)
+    else:
+        mx_val, mn_val = ts[mx_pos], ts[mn_pos]
+
+    n_mx = np.bincount(mx_rows, minlength=n_rows)
+    n_mn = np.bincount(mn_rows, minlength=n_rows)
+    first_mx = np.cumsum(n_mx) - n_mx
+    first_mn = np.cumsum(n_mn) - n_mn
+    # maxima and minima are truncated to the same count
+    n_diffs = np.minimum(n_mx, n_mn) - 1
+
+    # windows with fewer than two peak pairs get all zeros
+    means = np.zeros((n_rows, 3))
+    stds = np.zeros((n_rows, 3))
+    for n in np.unique(n_diffs[n_diffs > 0]):
+        rows = np.flatnonzero(n_diffs == n)
+        a = first_mx[rows][:,None] + np.arange(1, n+1)
+        b = first_mn[rows][:,None] + np.arange(1, n+1)
+        mx_first = (mx_pos[first_mx[rows]] < mn_pos[first_mn[rows]])[:,None]
+
+        diffs = np.empty((len(rows), n, 3), dtype=mx_val.dtype)
+        diffs[:,:,0] = mx_val[a] - mx_val[a-1]
+        diffs[:,:,1] = mn_val[b] - mn_val[b-1]
+        diffs[:,:,2] = np.where(mx_first, mn_val[b] - mx_val[a], mx_val[a] - mn_val[b])
+
+        means[rows] = diffs.mean(axis=1)
+        stds[rows] = diffs.std(axis=1)
+
+    return [means, stds]
+
+
 def calculate_ts_diffs(x, ts, delta=25, viz=0):
     '''Old version that computed temporal/periodicity differences in the 
     signal.  This was a misinterpretation of the journal article.  But the 
@@ -694,20 +1952,20 @@ def acc_3a(dat, segs=None):
     ax = plt.subplot(311)
     plt.plot(ts, dat.xa, 'k')
     plt.ylabel('Acc_X')
-    if segs:
+    if segs is not None:
         pltsegs(ax, segs)
 
     ax = plt.subplot(312)
     plt.plot(ts, dat.ya, 'k')
     plt.ylabel('Acc_Y')
-    if segs:
+    if segs is not None:
         pltsegs(ax, segs)
     
     ax = plt.subplot(313)
     plt.plot(ts, dat.za, 'k')
     plt.ylabel('Acc_Z')
     plt.xlabel('Time (s)')
-    if segs:
+    if segs is not None:
         pltsegs(ax, segs)
     
     plt.tight_layout()
@@ -715,21 +1973,21 @@ def acc_3a(dat, segs=None):
 
 def gather_data(data_files, act=None, sig_comps='mag', nfft=256, n_peaks=3):
     print "should avoid this"
-    X = pd.DataFrame()
+    blocks = []
     for fn in data_files:
         #print os.path.basename(fn)
         dat = load_file(fn, act=act)
         d = get_spec_features(dat, sig_comps=sig_comps, nFFT=nfft, n_peaks=n_peaks)
         d['subj'] = [int(os.path.basename(fn)[:-4])] * len(d)
 
-        X = X.append(d, ignore_index=True)
+        blocks.append(d)
 
-    return X
+    return concat_frames(blocks)
 
 
 def compute_spec_features(data, act=None, sig_comps='mag', nfft=256, n_peaks=3):
     print "should avoid this"
-    X = pd.DataFrame()
+    blocks = []
     for fn in data_files:
         #print os.path.basename(fn)
         subj_mask = data.subj.isin([i])
@@ -737,12 +1995,15 @@ def compute_spec_features(data, act=None, sig_comps='mag', nfft=256, n_peaks=3):
         d = get_spec_features(dat, sig_comps=sig_comps, nFFT=nfft, n_peaks=n_peaks)
         d['subj'] = [int(os.path.basename(fn)[:-4])] * len(d)
 
-        X = X.append(d, ignore_index=True)
+        blocks.append(d)
 
-    return X
+    return concat_frames(blocks)
 
 def split_data(Dat, subjects=None, actions=[3,4], test_ratio=0.3, X_coi=[], y_coi='', 
-    random_state=3):
+    random_state=3, index=None):
+    '''Splits every subject/action group of Dat in time, the first
+    1-test_ratio of its rows for training.  Groups are looked up through
+    index, a RowIndex of Dat, built here if not given.'''
     
     if subjects is None:
         subjects = [1,2,3,4,5,6,7,8,9,10,11,12,13,14,15]
@@ -755,23 +2016,31 @@ def split_data(Dat, subjects=None, actions=[3,4], test_ratio=0.3, X_coi=[], y_co
     #X_train, X_test, y_train, y_test = train_test_split(
     #        X, y, test_size=test_ratio, random_state=random_state)
     
-    X_train, y_train = pd.DataFrame(), pd.DataFrame([], columns=[y_coi])
-    X_test, y_test = pd.DataFrame(), pd.DataFrame([], columns=[y_coi])
+    if index is None:
+        index = RowIndex(Dat)
+
+    X_train, y_train = [], []
+    X_test, y_test = [], []
 
     for si in subjects:
         for ai in actions:
-            d = Dat[(Dat.subj==si) & (Dat.act==ai)]
+            d = index.take(Dat, subj=si, act=ai)
             n_rows = len(d)
             #print n_rows,
             n_test = int(n_rows*test_ratio)
             n_train = n_rows - n_test
 
-            X_train = X_train.append(d[X_coi][:n_train])
-            X_test = X_test.append(d[X_coi][n_train:n_rows])
-            y_train = y_train.append(d[y_coi][:n_train])
-            y_test = y_test.append(d[y_coi][n_train:n_rows])
+            X_train.append(d[X_coi][:n_train])
+            X_test.append(d[X_coi][n_train:n_rows])
+            y_train.append(d[y_coi][:n_train])
+            y_test.append(d[y_coi][n_train:n_rows])
             #print len(X_train), len(X_test)
 
+    X_train = concat_frames(X_train, ignore_index=False)
+    X_test = concat_frames(X_test, ignore_index=False)
+    y_train = concat_frames(y_train, ignore_index=False)
+    y_test = concat_frames(y_test, ignore_index=False)
+
     #return X, y
     return X_train, y_train.astype(int), X_test, y_test.astype(int)
 
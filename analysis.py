@@ -1,5 +1,8 @@
 from algorithms import *
+import os
 import time
+import json
+import hashlib
 
 import pandas as pd
 import numpy as np
@@ -8,10 +11,14 @@ from pandas.tools.plotting import scatter_matrix
 
 from scipy.stats import ttest_ind
 
-from sklearn.cross_validation import train_test_split
+from sklearn.cross_validation import train_test_split, StratifiedKFold
+from sklearn.grid_search import ParameterGrid
 from sklearn import svm
 from sklearn import tree
 from sklearn.linear_model import LogisticRegression
+from sklearn.externals.joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.metrics import accuracy_score
 
 from sklearn.mixture import GMM
 from sklearn.cluster import KMeans
@@ -25,6 +32,9 @@ col_names = ['ts','xa','ya','za','act']
 # xyz motion columns
 xyz = ['xa','ya','za']
 
+# fold scores remembered by cached_grid_search
+grid_cache_dir = data_dir+os.path.sep+'grid'
+
 
 # the classifiers to be used and their corresponding parameter set for GridSearchCV
 classifier_sets = [
@@ -55,17 +65,24 @@ def analysis_first(Dat):
     return clf
 
 def analysis_by_nfft(data_files, clf):
+    """F1 of clf telling walking (4) from standing (3) on the spectral peaks
+    of each signal at each FFT size.  Features for every size and signal
+    come from one spec_feature_pyramid call.
+    """
     ffts = [128, 192, 256, 384, 512]
     ffts = [128, 256, 512]
-    xcoi = ['pk0', 'pk1', 'pk2']
+    sigs = ['xa', 'ya', 'za', 'mag']
     #clf = svm.SVC()
 
+    pyr = spec_feature_pyramid(data_files, nffts=ffts, sig_comps=sigs, n_peaks=3)
+
     results = np.zeros((len(ffts),4))
-    for i, sig in enumerate(['xa', 'ya', 'za', 'mag']):
+    for i, sig in enumerate(sigs):
         print "Signal", sig
+        xcoi = [sig+'pk0', sig+'pk1', sig+'pk2']
         for j, fft_ in enumerate(ffts):
             print "FFT size:", fft_
-            Dat = gather_data(data_files, sig_comp=sig, nfft=fft_)
+            Dat = pyr.loc[fft_].reset_index()
             X_train, y_train, X_test, y_test = split_data(Dat, actions=[3,4], 
                 test_ratio=0.1, X_coi=xcoi, y_coi=['act'])
             y_train = np.ravel(y_train)
@@ -202,8 +219,8 @@ def split_Xy(X, y, subjects=None, actions=None, test_ratio=0.3, random_state=3):
     
     #X_train, y_train = pd.DataFrame(), pd.DataFrame()
     #X_test, y_test = pd.DataFrame(), pd.DataFrame()
-    X_train, y_train = np.empty([0,X.shape[1]]), np.empty([1,0])
-    X_test, y_test = np.empty([0,X.shape[1]]), np.empty([1,0])
+    X_train, y_train = [np.empty([0,X.shape[1]])], [np.empty(0)]
+    X_test, y_test = [np.empty([0,X.shape[1]])], [np.empty(0)]
 
     for yi in y_items:
         #d = Dat[(y==si)]
@@ -215,12 +232,15 @@ def split_Xy(X, y, subjects=None, actions=None, test_ratio=0.3, random_state=3):
         Xi = X[i_mask]
         yi = y[i_mask]
         
-        X_train = np.vstack((X_train, Xi[:][:n_train]))
-        X_test = np.vstack((X_test, Xi[:][n_train:n_rows]))
-        y_train = np.append(y_train, yi[:n_train])
-        y_test = np.append(y_test, yi[n_train:n_rows])
+        X_train.append(Xi[:][:n_train])
+        X_test.append(Xi[:][n_train:n_rows])
+        y_train.append(yi[:n_train])
+        y_test.append(yi[n_train:n_rows])
         #print len(X_train), len(X_test)
 
+    X_train, X_test = np.concatenate(X_train), np.concatenate(X_test)
+    y_train, y_test = np.concatenate(y_train), np.concatenate(y_test)
+
     #return X, y
     return X_train, y_train.astype(int), X_test, y_test.astype(int)
 
@@ -285,7 +305,7 @@ def analysis_classify_activity(clf, data, sig_comp='ya'):
         # frequency domain features
         print "Extracting frequency features..."
         t = time.time()
-        X, y = np.empty([0,3]), np.empty([1,0])
+        X, y = [np.empty([0,3])], [np.empty(0)]
         for i in act_n:
             d = data[data.subj.isin([i])]
 
@@ -294,9 +314,9 @@ def analysis_classify_activity(clf, data, sig_comp='ya'):
             #f['subj'] = [i] * f.shape[0]
             #feats_freq.append(f)
             act_col = [i] * f.shape[0]
-            y = np.append(y, act_col)
-            X = np.vstack((X, f))
-        y = y.astype(int)
+            y.append(act_col)
+            X.append(f)
+        X, y = np.concatenate(X), np.concatenate(y).astype(int)
         print "Time:", time.time() - t
 
 
@@ -361,35 +381,59 @@ def analysis_compare_time_freq(clf, data):
 
 
 
-def analysis_classify_walkers_louo(clf, X, y, parms={}):
+def analysis_classify_walkers_louo(clf, X, y, parms={}, n_jobs=1, times=False):
+    """Leave one user out: for every user fits clf to tell that user apart
+    from all the others and scores it on a held out split.
+
+    The users are fitted in n_jobs worker processes, each on a fresh clone
+    of clf, so with a fixed random_state the scores match a serial run.
+    Returns the per-user scores, and with times=True also an array of
+    (fit time, predict time) per user.
+    """
     # list of scores for each iteration of user verification
     print 'LOUO'
-    lo_scores = []
+    clf.set_params(**parms)
+    X = np.asarray(X)
+
+    runs = Parallel(n_jobs=n_jobs)(
+        delayed(louo_fit)(clf, X, y, lo) for lo in range(1,max(y)+1))
 
-    for lo in range(1,max(y)+1):
-        # revise y_labels for Leave One Out Analysis
-        yi = np.copy(y)
-        yi[yi != lo] = 0
-        yi[yi == lo] = 1
-        #print yi.mean()
-        # make train/test sets
-        X_train, X_test, y_train, y_test = train_test_split(
-            X, yi, train_size=.7, random_state=3)
-        clf.set_params(**parms)
-        #print y_train.mean(), y_test.mean()
-
-        # fit classifier and score classifier
-        clf.fit(X_train, y_train)
-        score = clf.score(X_test, y_test)
-        lo_scores.append(score)
     print clf
-    print 'train:', X_train.shape
-    print 'test:', X_test.shape
+    print 'train:', runs[-1][3]
+    print 'test:', runs[-1][4]
     
-    scores = np.array(lo_scores)
+    scores = np.array([r[0] for r in runs])
+    if times:
+        return scores, np.array([r[1:3] for r in runs])
     return scores #.mean(), scores.std()
 
 
+def louo_fit(clf, X, y, lo):
+    """One leave one user out run for analysis_classify_walkers_louo.
+    Returns (score, fit time, predict time, train shape, test shape).
+    """
+    clf = clone(clf)
+    # revise y_labels for Leave One Out Analysis
+    yi = np.copy(y)
+    yi[yi != lo] = 0
+    yi[yi == lo] = 1
+    # make train/test sets
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, yi, train_size=.7, random_state=3)
+
+    # fit classifier and score classifier
+    t = time.time()
+    clf.fit(X_train, y_train)
+    fit_time = time.time() - t
+
+    t = time.time()
+    y_pred = clf.predict(X_test)
+    predict_time = time.time() - t
+
+    score = accuracy_score(y_test, y_pred)
+    return score, fit_time, predict_time, X_train.shape, X_test.shape
+
+
 def plot_as_pca(X,y):
     pca = PCA(n_components=5)
     Xt = pca.fit_transform(X)
@@ -416,65 +460,87 @@ def plot_as_pca(X,y):
     return Xtpd
 
 def plot_windowed_time_features(data_file, n, sig='ya', win_size=2):
-    dat = load_data(data_file[n:n+1], act=4)
+    dat = load_data(data_file[n:n+1], act=4, compact=False)
     r = extract_windowed_time_features(
         dat.ya.as_matrix(), dat.ts.as_matrix(), win_size, 40)
     plt.plot(r)
     plt.show()
 
 def make_freq_features(data, nFFT=256, n_peaks=6, delta=4,
-    yrng=range(1,16), ycol='subj'):
+    yrng=range(1,16), ycol='subj', n_jobs=1, use_cache=True, index=None):
+    """Spectral peak features for every group in yrng.  With n_jobs > 1 the
+    groups are processed in a pool of worker processes, each one sent only
+    its own signal columns.  Results are kept in the feature store (see
+    cached_features) unless use_cache is False.  Groups are sliced out
+    through index, a RowIndex of data (see group_frames).
+    """
 
     #subj_n = range(1,16)#[1]
     sig_comps = ['xa', 'ya', 'za']
     #n_sig = len(sig_comps)
 
+    if use_cache:
+        params = dict(nFFT=nFFT, n_peaks=n_peaks, delta=delta, yrng=list(yrng),
+            ycol=ycol, sig_comps=sig_comps,
+            spectral=spectral_config())
+        return cached_features('freq', data, sig_comps + [ycol], params,
+            lambda: make_freq_features(data, nFFT=nFFT, n_peaks=n_peaks, delta=delta,
+                yrng=yrng, ycol=ycol, n_jobs=n_jobs, use_cache=False, index=index))
+
     # frequency domain features
     print "Extracting frequency features..."
     t = time.time()
     #X_freq, y_freq = np.empty([0,n_peaks]), np.empty([1,0])
     #X_freq, y_freq = np.empty([0,n_peaks*n_sig]), np.empty([1,0])
-    X = pd.DataFrame()
-    y = np.array([])
-    for i in yrng: 
-        dat = data[data[ycol].isin([i])]
-        
-        f = get_spec_features(dat, sig_comps,
-                nFFT=nFFT, n_peaks=n_peaks, delta=delta)
-        
-        y_col = pd.DataFrame({'subj': [i] * f.shape[0]})
-        y = np.append(y, y_col)#, ignore_index=True)
-        X = X.append(f, ignore_index=True)
-
-    y = y.astype(int)
+    groups = group_frames(data, ycol, yrng, index)
+    # workers compute with this process' backends, which the cache key records
+    backends = backend_config()
+    X = Parallel(n_jobs=n_jobs)(
+        delayed(run_with_backends)(backends, get_spec_features, d[sig_comps], sig_comps,
+            nFFT=nFFT, n_peaks=n_peaks, delta=delta)
+        for d in groups)
+    y = [np.array([])] + [np.repeat(i, f.shape[0]) for i, f in zip(yrng, X)]
+
+    X = concat_frames(X)
+    y = np.concatenate(y).astype(int)
     print "Time:", time.time() - t
     print 'Feature Matrix:', X.shape[0], 'rows,', X.shape[1], 'columns.'
 
     return X, y
 
 
-def make_time_features(data, win_size=5, delta=40, yrng=range(1,16), ycol='subj', typ='amp', jrk=1): 
+def make_time_features(data, win_size=5, delta=40, yrng=range(1,16), ycol='subj', typ='amp', jrk=1,
+    hop_size=None, n_jobs=1, use_cache=True, index=None): 
+    """Windowed time features for every group in yrng.  n_jobs, use_cache
+    and index work as in make_freq_features.
+    """
 
     #subj_n = range(1,16)#[1]
     sig_comps = ['xa', 'ya', 'za']
     #n_sig = len(sig_comps)
 
-    X = pd.DataFrame()
-    y = np.array([])
-    
+    if use_cache:
+        params = dict(win_size=win_size, delta=delta, yrng=list(yrng), ycol=ycol,
+            typ=typ, jrk=jrk, hop_size=hop_size, sig_comps=sig_comps)
+        ts_col = ['ts'] if 'ts' in data.columns else []
+        return cached_features('time', data, sig_comps + ts_col + [ycol], params,
+            lambda: make_time_features(data, win_size=win_size, delta=delta, yrng=yrng,
+                ycol=ycol, typ=typ, jrk=jrk, hop_size=hop_size, n_jobs=n_jobs,
+                use_cache=False, index=index))
+
     print "Extracting time features..."
     t = time.time()
-    for i in yrng: #subj_n:
-        d = data[data[ycol].isin([i])]
-
-        f = extract_windowed_time_features(
-            d[sig_comps], d.ts.as_matrix(), win_size, delta, typ=typ, jrk=jrk)
-        y_col = pd.DataFrame({ycol: [i] * f.shape[0]})
-        
-        y = np.append(y, y_col) #, ignore_index=True)
-        X = X.append(f, ignore_index=True)
-
-    y = y.astype(int)
+    groups = group_frames(data, ycol, yrng, index)
+    backends = backend_config()
+    X = Parallel(n_jobs=n_jobs)(
+        delayed(run_with_backends)(backends, extract_windowed_time_features,
+            d[sig_comps], frame_ts(d), win_size, delta, typ=typ, jrk=jrk,
+            hop_size=hop_size)
+        for d in groups)
+    y = [np.array([])] + [np.repeat(i, f.shape[0]) for i, f in zip(yrng, X)]
+
+    X = concat_frames(X)
+    y = np.concatenate(y).astype(int)
     print "Time:", time.time() - t
 
     print 'Feature Matrix:', X.shape[0], 'rows,', X.shape[1], 'columns.'
@@ -482,6 +548,21 @@ def make_time_features(data, win_size=5, delta=40, yrng=range(1,16), ycol='subj'
     return X, y
 
 
+def group_frames(data, ycol, yrng, index=None):
+    """Yields data[data[ycol] == i] for every i in yrng.  For ycol 'subj'
+    or 'act' the groups are slices through index, a RowIndex of data that
+    is built if not given; other columns fall back to masks.
+    """
+    if ycol not in ['subj', 'act']:
+        for i in yrng:
+            yield data[data[ycol].isin([i])]
+        return
+    if index is None:
+        index = RowIndex(data)
+    for i in yrng:
+        yield index.take(data, **{ycol: i})
+
+
 '''*****************************************************************************
 Analyses
 *****************************************************************************'''
@@ -642,8 +723,13 @@ def run_analyses(X, y):
     return clf
 
 
-def analysis_grid_and_verify(clf, parameters, X, y):
-    """
+def analysis_grid_and_verify(clf, parameters, X, y, n_jobs=-1, search='grid'):
+    """Scores clf on authorizing user 1, grid searches parameters for it
+    and compares leave one user out scores before and after tuning.
+    The grid search and LOUO runs use n_jobs processes (all cores by
+    default) and the fold scores are cached, see cached_grid_search.
+    search='halving' uses halving_search instead, which drops weak
+    candidates on small subsets of the windows before fitting on all.
     """
     print 'data:', X.shape
 
@@ -673,15 +759,17 @@ def analysis_grid_and_verify(clf, parameters, X, y):
     print 'Initial Classifier score:', score
 
     print 'untuned louo'
-    scores = analysis_classify_walkers_louo(clf, X, y)
+    scores = analysis_classify_walkers_louo(clf, X, y, n_jobs=n_jobs)
     print scores
     print scores.mean(), scores.std()
 
-    print '* Grid Search *'
-    grid = grid_search.GridSearchCV(clf, parameters)
+    print '* Grid Search *', search
     # Fit tuned
     t = time.time()
-    grid.fit(X, yi)
+    if search == 'halving':
+        grid = halving_search(clf, parameters, X, yi, n_jobs=n_jobs)
+    else:
+        grid = cached_grid_search(clf, parameters, X, yi, n_jobs=n_jobs)
     print 'Fit time:', time.time() - t
 
     # Predict tuned
@@ -697,7 +785,7 @@ def analysis_grid_and_verify(clf, parameters, X, y):
 
     print
     print 'tuned louo'
-    scores = analysis_classify_walkers_louo(clf, X, y, parms=grid.best_params_)
+    scores = analysis_classify_walkers_louo(clf, X, y, parms=grid.best_params_, n_jobs=n_jobs)
     print scores 
     print scores.mean(), scores.std()
 
@@ -713,6 +801,158 @@ def analysis_grid_and_verify(clf, parameters, X, y):
     return clf #scores
 
 
+class SearchResult(object):
+    """Outcome of a parameter search with the GridSearchCV attributes the
+    analyses use: best_params_, best_score_, best_estimator_ (refitted on
+    all the data), grid_scores_ and predict.
+    """
+    def __init__(self, best_estimator, best_params, best_score, grid_scores):
+        self.best_estimator_ = best_estimator
+        self.best_params_ = best_params
+        self.best_score_ = best_score
+        self.grid_scores_ = grid_scores
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+def cached_grid_search(clf, parameters, X, y, n_folds=3, n_jobs=-1):
+    """Exhaustive search over parameters scored like GridSearchCV's
+    defaults: stratified n_folds CV, clf.score, test-size weighted mean.
+
+    Every (candidate, fold) fit runs in a pool of n_jobs processes and its
+    score is saved under grid_cache_dir, keyed on the estimator with its
+    parameters, the fold and a hash of X and y.  Searches that repeat a
+    candidate on the same data, e.g. re-running the script after changing
+    one classifier, only fit what is new.  Returns a SearchResult.
+    """
+    X, y = np.asarray(X), np.asarray(y)
+    folds = list(StratifiedKFold(y, n_folds=n_folds))
+    candidates = list(ParameterGrid(parameters))
+    keys = [[fold_key(clf, p, k, n_folds) for k in range(n_folds)] for p in candidates]
+
+    memo_file = os.path.join(grid_cache_dir, data_key(X, y) + '.json')
+    memo = {}
+    if os.path.exists(memo_file):
+        with open(memo_file) as f:
+            memo = json.load(f)
+
+    todo = [(i, k) for i in range(len(candidates)) for k in range(n_folds)
+        if keys[i][k] not in memo]
+    print len(todo), 'of', len(candidates)*n_folds, 'fold fits not cached'
+    runs = Parallel(n_jobs=n_jobs)(
+        delayed(fit_fold)(clf, candidates[i], X, y, folds[k][0], folds[k][1])
+        for i, k in todo)
+
+    if runs:
+        for (i, k), r in zip(todo, runs):
+            memo[keys[i][k]] = r
+        if not os.path.isdir(grid_cache_dir):
+            os.makedirs(grid_cache_dir)
+        with open(memo_file + '.tmp', 'w') as f:
+            json.dump(memo, f)
+        if os.path.exists(memo_file):
+            os.remove(memo_file)
+        os.rename(memo_file + '.tmp', memo_file)
+
+    grid_scores = []
+    for i, p in enumerate(candidates):
+        fold_scores = [memo[k] for k in keys[i]]
+        # weighted by test size, as GridSearchCV does with iid=True
+        score = sum(s*n for s, n in fold_scores) / float(sum(n for s, n in fold_scores))
+        grid_scores.append((p, score, [s for s, n in fold_scores]))
+
+    best = sorted(grid_scores, key=lambda g: g[1], reverse=True)[0]
+    best_estimator = clone(clf).set_params(**best[0]).fit(X, y)
+    return SearchResult(best_estimator, best[0], best[1], grid_scores)
+
+
+def fit_fold(clf, parms, X, y, train, test):
+    """Fits a clone of clf with parms on one CV fold.
+    Returns [score, number of test samples].
+    """
+    clf = clone(clf).set_params(**parms)
+    clf.fit(X[train], y[train])
+    return [clf.score(X[test], y[test]), len(test)]
+
+
+def fold_key(clf, parms, fold, n_folds):
+    """Cache key for one fold of one candidate in cached_grid_search"""
+    clf = clone(clf).set_params(**parms)
+    return '%s|%r|%d/%d' % (type(clf).__name__,
+        sorted(clf.get_params(deep=False).items()), fold, n_folds)
+
+
+def data_key(X, y):
+    """md5 of the contents of X and y"""
+    h = hashlib.md5()
+    for a in [X, y]:
+        a = np.ascontiguousarray(a)
+        h.update(str(a.dtype) + str(a.shape))
+        h.update(a.view(np.uint8))
+    return h.hexdigest()
+
+
+def halving_search(clf, parameters, X, y, n_folds=3, factor=3, n_jobs=-1, seed=3):
+    """Successive halving over parameters.  Every candidate is first fit on
+    a small stratified subset of each CV training fold, then only the best
+    1/factor of them go on to a factor times larger subset, until the last
+    round fits the survivors on the full folds.  Each round is scored on
+    the full test folds like cached_grid_search, so best_score_ is
+    comparable to an exhaustive search, for a fraction of the fits.
+
+    grid_scores_ holds each candidate's score from the last round it
+    reached.  Returns a SearchResult.
+    """
+    X, y = np.asarray(X), np.asarray(y)
+    folds = list(StratifiedKFold(y, n_folds=n_folds))
+    candidates = list(ParameterGrid(parameters))
+    rng = np.random.RandomState(seed)
+    folds = [(nested_order(train, y, rng), test) for train, test in folds]
+
+    n_rounds = max(int(np.ceil(np.log(len(candidates)) / np.log(factor))), 1)
+    alive = range(len(candidates))
+    last = {}
+    cost = 0.
+    for r in range(n_rounds):
+        frac = float(factor) ** (r - n_rounds + 1)
+        runs = Parallel(n_jobs=n_jobs)(
+            delayed(fit_fold)(clf, candidates[i], X, y,
+                train[:max(int(len(train)*frac), factor*n_folds)], test)
+            for i in alive for train, test in folds)
+        cost += len(runs)*frac
+
+        scores = []
+        for j, i in enumerate(alive):
+            fold_scores = runs[j*n_folds:(j+1)*n_folds]
+            score = sum(s*n for s, n in fold_scores) / float(sum(n for s, n in fold_scores))
+            last[i] = (candidates[i], score, [s for s, n in fold_scores])
+            scores.append(score)
+        print 'round', r, len(alive), 'candidates on', '%.3f' % frac, 'of the training folds'
+
+        # stable, so ties keep grid order as GridSearchCV's best does
+        keep = int(np.ceil(len(alive) / float(factor))) if r < n_rounds-1 else 1
+        alive = [alive[j] for j in sorted(range(len(alive)), key=lambda j: -scores[j])[:keep]]
+    # fit time grows at least linearly with the rows, so this undercounts
+    print 'cost of %.1f full fold fits, exhaustive search takes %d' % (cost, len(candidates)*n_folds)
+
+    best = last[alive[0]]
+    best_estimator = clone(clf).set_params(**best[0]).fit(X, y)
+    return SearchResult(best_estimator, best[0], best[1], [last[i] for i in range(len(candidates))])
+
+
+def nested_order(train, y, rng):
+    """Shuffles the train indices so every prefix has about the class
+    proportions of the whole, i.e. train[:n] is a stratified subsample.
+    """
+    train = train[rng.permutation(len(train))]
+    rank = np.zeros(len(train))
+    for c in np.unique(y[train]):
+        m = y[train] == c
+        rank[m] = (np.arange(m.sum()) + .5) / m.sum()
+    return train[np.argsort(rank, kind='mergesort')]
+
+
 def analysis_by_features(Xf, yf):
     pt = 1
     clf = tree.DecisionTreeClassifier(class_weight='balanced', min_samples_leaf=10)#, min_samples_split=20)#, max_features=4)
@@ -860,14 +1100,14 @@ def time_domain_viz(data_files):
     subj = [1,5,8]
     t1,t2 = 520,1040
 
-    dat = load_file(data_files[8], act=4)
+    dat = load_file(data_files[8], act=4, compact=False)
     x = dat.ya[t1:t2]
     ts = dat.ts[t1:t2].as_matrix()
     r = calculate_ts_diffs(x, ts, delta=40, viz=1)
 
 
 def exploratory_visualization(data_files):
-    dat = load_file(data_files[0], act=4)
+    dat = load_file(data_files[0], act=4, compact=False)
     dat.ts = dat.ts-min(dat.ts)
     #x = data.ya.as_matrix()
 
@@ -1006,8 +1246,12 @@ def show_features_by_subject(data_files=data_files):
 
 if __name__=="__main__":
     #pass
-    data = load_data(data_files)
-    datawalk = data[data.act==4]
+    # read through the signal store once build_signal_store has written it
+    store = None
+    if os.path.exists(os.path.join(store_dir, 'store.json')):
+        store = open_signal_store()
+    data, index = load_data(data_files, with_index=True, store=store)
+    datawalk = index.take(data, act=4)
     
     Xt, yt = make_time_features(datawalk, win_size=4.923077)
     Xf, yf = make_freq_features(datawalk, delta=40)
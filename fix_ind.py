@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import os
+import json
 
 
 data_dir = os.path.realpath('.') +'\data'
@@ -187,6 +188,16 @@ fix.append([14,
 def do_fixes(fix):
     for f in fix:
         write_fixed_file(f)
+    # features were built from the old labels.  The feature store and its
+    # path belong to algorithms, which needs matplotlib, sklearn and
+    # time_series_segmentation; the labels are fixed without them.
+    try:
+        from algorithms import clear_feature_cache
+    except ImportError as e:
+        print 'feature cache not cleared, algorithms could not be imported:', e
+        print 'cached features are keyed on the data they were built from, so none are reused wrongly'
+        return
+    clear_feature_cache()
 
 def write_fixed_file(fix):
     index_num = fix[0]
@@ -201,13 +212,9 @@ def write_fixed_file(fix):
     
     print 'index_num', index_num
 
-    # create new action vector
-    new_ind = []
-    for s in segs:
-        act,a,b = s
-        #print act,a,b
-        n_samp = b-a
-        new_ind.extend([act]*n_samp)
+    # create new action vector, b-a samples of every segment
+    segs = np.array(segs, dtype=np.int64)
+    new_ind = np.repeat(segs[:,0], np.maximum(segs[:,2] - segs[:,1], 0))
 
     # append remainder of original if new_ind is shorter
     print len(dat.act)
@@ -215,18 +222,29 @@ def write_fixed_file(fix):
     diff = len(dat.act) - len(new_ind)
     if diff > 0:
         print "appending original"
-        new_ind.extend(dat.act[-diff:])
+        new_ind = np.concatenate((new_ind, dat.act.values[-diff:]))
         print len(new_ind)
     else:
         print 'all samples accounted for'
+        # labels past the end of the recording were never used
+        new_ind = new_ind[:len(dat.act)]
     #print len(dat.act) - len(new_ind)
 
+    # store the runs of equal labels as [act, start, stop) rows
+    starts = np.concatenate(([0], np.flatnonzero(new_ind[1:] != new_ind[:-1]) + 1))
+    stops = np.append(starts[1:], len(new_ind))
+    table = {'n_samples': len(new_ind),
+        'segments': [[int(new_ind[a]), int(a), int(b)] for a, b in zip(starts, stops)]}
 
-    new_file = dat_file[:-3]+'txt'
+    new_file = dat_file[:-3]+'json'
     print new_file
     with open(new_file, 'w') as f:
-        for i in new_ind:
-            f.write(str(i)+'\n')
+        json.dump(table, f)
+
+    # the per sample labels of earlier versions would be shadowed anyway
+    old_file = dat_file[:-3]+'txt'
+    if os.path.exists(old_file):
+        os.remove(old_file)
     print
 
 
@@ -0,0 +1,183 @@
+'''
+Real time user authorization from a live 52 Hz accelerometer stream.
+
+The features are computed with the same code as the offline extractors, so
+a window seen by StreamingAuthenticator gives exactly the row that
+make_time_features / make_freq_features produce for it.
+'''
+import numpy as np
+
+from algorithms import compute_time_stats_2d, spec_peak_freqs, spec_power, segment_power
+
+
+class StreamingAuthenticator(object):
+    """Classifies a stream of (x, y, z) samples window by window.
+
+    Samples go into a preallocated ring buffer holding the last window.
+    Every hop samples (default: one window, as offline) the window's
+    features are computed and passed to clf, which must have been fit on
+    the matching offline features:
+
+        features='freq'  make_freq_features(data, nFFT, n_peaks, spec_delta)
+        features='time'  make_time_features(data, win_size, delta, typ=typ, jrk=jrk)
+        features='both'  np.hstack((Xf, Xt)) of the two above
+
+    The default win_size of 4.923077 s is nFFT samples at 52 Hz so both
+    feature sets cover the same windows, as in analysis.py.  Pushing a
+    sample costs a copy into the buffer, work and memory per window are
+    bounded by the window size.
+    """
+    def __init__(self, clf, features='both', win_size=4.923077, delta=40,
+        typ='amp', jrk=1, nFFT=256, n_peaks=6, spec_delta=40, hop=None, fs=52.):
+        if features not in ['time', 'freq', 'both']:
+            raise ValueError("features must be 'time', 'freq' or 'both'")
+        self.clf = clf
+        self.features = features
+        self.delta = delta
+        self.typ = typ
+        self.jrk = jrk
+        self.nFFT = nFFT
+        self.n_peaks = n_peaks
+        self.spec_delta = spec_delta
+        self.fs = fs
+
+        # same sample times and window length as load_file and
+        # extract_windowed_time_features
+        ts = np.arange(0, (int(win_size*fs) + 2)/fs, 1/fs)
+        self.win_samp = int(round(win_size/(ts[1]-ts[0])))
+        self.ts = ts[:self.win_samp]
+        self.win_len = self.win_samp
+        if features != 'time':
+            self.win_len = max(self.win_len, nFFT)
+        self.hop = hop or self.win_len
+
+        # every sample is written twice, win_len apart, so the last win_len
+        # samples are always the contiguous slice buf[pos:pos+win_len]
+        self.buf = np.zeros((3, 2*self.win_len))
+        self.reset()
+
+    def reset(self):
+        """Forgets the buffered samples"""
+        self.pos = 0
+        self.n_seen = 0
+        self.since_emit = 0
+
+    def window(self):
+        """(3, win_len) view of the newest samples, oldest first"""
+        return self.buf[:, self.pos:self.pos+self.win_len]
+
+    def push(self, x, y, z):
+        """Adds one sample.  Returns (features, decision) when it completes
+        a window, else None.  decision is clf's prediction, 1 = authorized.
+        """
+        buf, n = self.buf, self.win_len
+        buf[0, self.pos] = buf[0, self.pos+n] = x
+        buf[1, self.pos] = buf[1, self.pos+n] = y
+        buf[2, self.pos] = buf[2, self.pos+n] = z
+        self.pos = (self.pos + 1) % n
+        self.n_seen += 1
+        self.since_emit += 1
+
+        if self.n_seen < n or self.since_emit < self.hop:
+            return None
+        self.since_emit = 0
+        feats = self.extract(self.window())
+        return feats, self.clf.predict(feats[None, :])[0]
+
+    def feed(self, samples):
+        """push for every row of an (n, 3) array.  Returns the list of
+        (features, decision) for the windows completed.
+        """
+        out = []
+        for x, y, z in np.asarray(samples):
+            r = self.push(x, y, z)
+            if r is not None:
+                out.append(r)
+        return out
+
+    def extract(self, W):
+        """Feature row of the (3, win_len) window W, laid out as the
+        offline feature matrices.
+        """
+        feats = []
+        if self.features != 'time':
+            feats.append(self.freq_features(W[:, -self.nFFT:]))
+        if self.features != 'freq':
+            feats.append(self.time_features(W[:, -self.win_samp:]))
+        return np.concatenate(feats)
+
+    def time_features(self, W):
+        """extract_windowed_time_features of one window per axis"""
+        return compute_time_stats_2d(W, self.ts, delta=self.delta, typ=self.typ,
+            jrk=self.jrk).ravel()
+
+    def freq_features(self, W):
+        """get_spec_features of one nFFT window per axis"""
+        f, t, Sxx = spec_power(W, fs=self.fs, nFFT=self.nFFT)
+        # Sxx is (3, n_freqs, 1)
+        return spec_peak_freqs(Sxx[:, :, 0].T, f, self.n_peaks, self.spec_delta).ravel()
+
+
+class IncrementalSpectrogram(object):
+    """extract_spec_features for a stream, one spectrogram column at a time.
+
+    The last nFFT samples of every channel are kept in a ring buffer.  Once
+    the first nFFT samples are in, and then every nFFT - noverlap samples,
+    only the newest column is computed (detrend, window, one real FFT) and
+    its n_peaks peak frequencies found, so an update costs
+    O(nFFT log nFFT) however long the stream.  The columns are those of
+    spectrogram(x, nfft=nFFT, nperseg=nFFT, noverlap=noverlap), with the
+    same cached tukey window, so the peak rows equal
+    extract_spec_features(x, nFFT, n_peaks, delta) for one channel, or
+    get_spec_features' row layout for several.
+    """
+    def __init__(self, nFFT=256, noverlap=None, n_peaks=3, delta=50,
+        n_channels=1, fs=52.):
+        if noverlap is None:
+            noverlap = nFFT/2
+        if not 0 <= noverlap < nFFT:
+            raise ValueError('noverlap must be in [0, nFFT)')
+        self.nFFT = nFFT
+        self.step = nFFT - noverlap
+        self.n_peaks = n_peaks
+        self.delta = delta
+        self.fs = fs
+
+        # written twice, nFFT apart, see StreamingAuthenticator
+        self.buf = np.zeros((n_channels, 2*nFFT))
+        self.column = None
+        self.reset()
+
+    def reset(self):
+        """Forgets the buffered samples"""
+        self.pos = 0
+        self.n_seen = 0
+
+    def push(self, sample):
+        """Adds one sample (a scalar, or one value per channel).  Returns the
+        peak frequencies of the new column when one completes, else None.
+        The column's PSD, (n_channels, n_freqs), is kept in self.column.
+        """
+        n = self.nFFT
+        self.buf[:, self.pos] = self.buf[:, self.pos+n] = sample
+        self.pos = (self.pos + 1) % n
+        self.n_seen += 1
+
+        if self.n_seen < n or (self.n_seen - n) % self.step:
+            return None
+        f, self.column = segment_power(self.buf[:, self.pos:self.pos+n], self.fs)
+        return spec_peak_freqs(self.column.T, f, self.n_peaks, self.delta).ravel()
+
+    def feed(self, x):
+        """push for every sample of x, (n,) or (n, n_channels).  Returns the
+        peak rows of the columns completed, (n_columns, n_channels*n_peaks).
+        """
+        x = np.asarray(x)
+        rows = []
+        for sample in x:
+            r = self.push(sample)
+            if r is not None:
+                rows.append(r)
+        if not rows:
+            return np.zeros((0, self.buf.shape[0]*self.n_peaks))
+        return np.array(rows)
@@ -0,0 +1,52 @@
+'''
+Parity of every available peakdet backend with the reference loop.
+
+    python -m unittest test_peakdet
+
+The recorded check reads the first walking stretch of data_files[0]
+through load_file and is skipped when the recordings are not in data_dir.
+'''
+import os
+import unittest
+
+import numpy as np
+
+import algorithms
+from algorithms import peakdet_parity, peakdet_backends, load_file, data_files
+
+
+class PeakdetParityTest(unittest.TestCase):
+
+    def test_backends(self):
+        self.assertTrue('numpy' in peakdet_backends)
+        if algorithms.numba is not None:
+            self.assertTrue('numba' in peakdet_backends)
+
+    def test_random_walks(self):
+        self.assertEqual(peakdet_parity(n_random=20), [])
+
+    def test_edge_cases(self):
+        rng = np.random.RandomState(5)
+        walk = rng.randn(2048).cumsum()*10
+        with_nan = walk.copy()
+        with_nan[[10, 700, 701, 1500]] = np.nan
+        signals = [
+            walk.astype(np.int16),      # compact load_file columns
+            walk.astype(np.float32),
+            with_nan,
+            np.zeros(1024),             # flat, no peaks
+            np.tile([0., 50.], 512),    # a turning point every sample
+        ]
+        self.assertEqual(peakdet_parity(signals, n_random=0), [])
+
+    def test_recorded(self):
+        if not os.path.exists(data_files[0]):
+            self.skipTest('recordings not found in ' + algorithms.data_dir)
+        dat = load_file(data_files[0], act=4)
+        # 40 windows of 256 samples per axis, about 200 s of walking
+        signals = [dat[c].values[:40*256] for c in ['xa', 'ya', 'za', 'mag']]
+        self.assertEqual(peakdet_parity(signals, n_random=0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()